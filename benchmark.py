@@ -0,0 +1,183 @@
+# benchmark.py
+# ------------
+# Plays headless games of my_team.py against another team (baseline_team by
+# default) on a process pool and writes one JSON report with the win rate, the
+# score distribution and the move time percentiles of our agents.
+#
+# Run it from the directory that contains capture.py, e.g.
+#
+#     python agents/team_name_1/benchmark.py -l defaultCapture,RANDOM1 -n 20 -o report.json
+#
+# Every seed is played twice, once as red and once as blue.  With --baseline
+# it compares the run against an earlier report and exits with status 1 when
+# the win rate dropped or the p99 move time grew beyond the tolerances.
+
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+#the contest modules (capture, layout, ...) live in the working directory
+sys.path.insert(0, os.getcwd())
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+TEAM = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'my_team.py')
+
+
+def percentiles(samples):
+    """
+    Nearest rank percentiles of a list of numbers.
+    """
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+
+    def at(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {'count': len(ordered), 'mean': sum(ordered) / len(ordered), 'min': ordered[0],
+            'p25': at(.25), 'p50': at(.5), 'p75': at(.75), 'p95': at(.95), 'p99': at(.99),
+            'max': ordered[-1]}
+
+
+def timed_choose_action(agent, move_times):
+    choose_action = agent.choose_action
+
+    def timed(game_state):
+        start = time.perf_counter()
+        try:
+            return choose_action(game_state)
+        finally:
+            move_times.append((time.perf_counter() - start) * 1000)
+    agent.choose_action = timed
+
+
+def play(task):
+    """
+    Plays one game in a worker process and returns its result, scores are
+    from the point of view of our team.
+    """
+    import capture
+
+    team, opponent, team_opts, layout_name, seed, red, length = task
+    argv = ['-r', team, '-b', opponent] if red else ['-r', opponent, '-b', team]
+    argv += ['-l', layout_name, '-Q', '-i', str(length)]
+    if team_opts:
+        argv += ['--redOpts' if red else '--blueOpts', team_opts]
+    result = {'layout': layout_name, 'seed': seed, 'red': red}
+    move_times = []
+    try:
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            options = capture.read_command(argv)
+            for agent in options['agents']:
+                if agent.index % 2 == (0 if red else 1):
+                    timed_choose_action(agent, move_times)
+            random.seed(seed)
+            games = capture.run_games(**options)
+        score = games[0].state.data.score
+    except Exception as e:
+        result.update(error='%s: %s' % (type(e).__name__, e), score=None, outcome='crash', move_ms=move_times)
+        return result
+    score = score if red else -score
+    outcome = 'win' if score > 0 else 'loss' if score < 0 else 'tie'
+    result.update(score=score, outcome=outcome, move_ms=move_times)
+    return result
+
+
+def summarize(games):
+    played = [g for g in games if g['outcome'] != 'crash']
+    outcomes = [g['outcome'] for g in games]
+    summary = {'games': len(games),
+               'wins': outcomes.count('win'),
+               'losses': outcomes.count('loss'),
+               'ties': outcomes.count('tie'),
+               'crashes': outcomes.count('crash'),
+               'win_rate': outcomes.count('win') / len(games) if games else 0.,
+               'score': percentiles([g['score'] for g in played]),
+               'move_ms': percentiles([t for g in games for t in g['move_ms']])}
+    return summary
+
+
+def report(games):
+    layouts = sorted(set(g['layout'] for g in games))
+    return {'summary': summarize(games),
+            'layouts': dict((name, summarize([g for g in games if g['layout'] == name])) for name in layouts),
+            'games': [dict((k, v) for k, v in g.items() if k != 'move_ms') for g in games]}
+
+
+def regressions(summary, baseline, win_tolerance, latency_tolerance):
+    """
+    What got worse compared with the summary of a baseline report.
+    """
+    found = []
+    if summary['win_rate'] < baseline['win_rate'] - win_tolerance:
+        found.append('win rate %.3f is below the baseline %.3f' % (summary['win_rate'], baseline['win_rate']))
+    if summary['move_ms'] and baseline['move_ms']:
+        p99, baseline_p99 = summary['move_ms']['p99'], baseline['move_ms']['p99']
+        if p99 > baseline_p99 * (1 + latency_tolerance):
+            found.append('p99 move time %.2f ms is above the baseline %.2f ms' % (p99, baseline_p99))
+    if summary['crashes'] > baseline['crashes']:
+        found.append('%d games crashed, %d in the baseline' % (summary['crashes'], baseline['crashes']))
+    return found
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark my_team against another team on many games')
+    parser.add_argument('-l', '--layouts', default='defaultCapture',
+                        help='comma separated layouts, RANDOM<n> for generated ones')
+    parser.add_argument('-n', '--seeds', type=int, default=10, help='seeds per layout, each played as red and blue')
+    parser.add_argument('--first-seed', type=int, default=0, help='first seed')
+    parser.add_argument('-b', '--opponent', default='baseline_team', help='team to play against')
+    parser.add_argument('--opts', default='', help='team options of my_team, as for --redOpts')
+    parser.add_argument('-i', '--length', type=int, default=1200, help='moves per game')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('-o', '--output', help='write the report to this JSON file')
+    parser.add_argument('--baseline', help='earlier report to compare against')
+    parser.add_argument('--win-tolerance', type=float, default=.05, help='allowed drop of the win rate')
+    parser.add_argument('--latency-tolerance', type=float, default=.2, help='allowed relative growth of the p99 move time')
+    args = parser.parse_args(argv)
+
+    tasks = [(TEAM, args.opponent, args.opts, layout_name, seed, red, args.length)
+             for layout_name in args.layouts.split(',')
+             for seed in range(args.first_seed, args.first_seed + args.seeds)
+             for red in (True, False)]
+    start = time.time()
+    with multiprocessing.Pool(args.processes) as pool:
+        games = pool.map(play, tasks, chunksize=1)
+    results = report(games)
+    results['seconds'] = time.time() - start
+
+    summary = results['summary']
+    print('%d games in %.0f s: %d wins, %d losses, %d ties, %d crashes (win rate %.3f)' % (
+        summary['games'], results['seconds'], summary['wins'], summary['losses'], summary['ties'],
+        summary['crashes'], summary['win_rate']))
+    if summary['score']:
+        print('score: mean %.2f, min %d, median %d, max %d' % (
+            summary['score']['mean'], summary['score']['min'], summary['score']['p50'], summary['score']['max']))
+    if summary['move_ms']:
+        print('move time: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, max %.2f ms' % (
+            summary['move_ms']['p50'], summary['move_ms']['p95'], summary['move_ms']['p99'], summary['move_ms']['max']))
+    for game in games:
+        if game['outcome'] == 'crash':
+            print('%s seed %d (%s) crashed: %s' % (game['layout'], game['seed'], 'red' if game['red'] else 'blue', game['error']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['summary']
+        found = regressions(summary, baseline, args.win_tolerance, args.latency_tolerance)
+        for regression in found:
+            print('regression: ' + regression)
+        if found:
+            return 1
+        print('no regression against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# check_simulator.py
+# ------------------
+# Cross-checks the SimState used by the lookahead search in my_team.py against
+# the real capture rules (GameState.generate_successor) on random rollouts.
+#
+# Run it from the directory that contains capture.py, e.g.
+#
+#     python agents/team_name_1/check_simulator.py -l defaultCapture -n 50
+#
+# It exits with status 1 and prints the first mismatches when the simulator
+# and the game disagree.
+
+import argparse
+import os
+import sys
+
+#the contest modules (capture, layout, ...) live in the working directory
+sys.path.insert(0, os.getcwd())
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+import capture
+import layout
+from my_team import cross_check_simulator
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Cross-check the search simulator against capture.py')
+    parser.add_argument('-l', '--layout', default='defaultCapture', help='layout to play on')
+    parser.add_argument('-n', '--rollouts', type=int, default=20, help='number of random rollouts')
+    parser.add_argument('-s', '--steps', type=int, default=400, help='moves per rollout')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the rollouts')
+    args = parser.parse_args(argv)
+
+    game_layout = layout.get_layout(args.layout)
+    if game_layout is None:
+        parser.error('layout %s not found' % args.layout)
+    game_state = capture.GameState()
+    game_state.initialize(game_layout, 4)
+
+    mismatches = cross_check_simulator(game_state, args.rollouts, args.steps, args.seed)
+    if mismatches:
+        for rollout, step, field, simulated, real in mismatches[:20]:
+            print('rollout %d, step %d: %s is %r in the simulator but %r in the game' % (
+                rollout, step, field, simulated, real))
+        print('%d mismatches' % len(mismatches))
+        return 1
+    print('simulator agrees with the game on %d rollouts of %d moves' % (args.rollouts, args.steps))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
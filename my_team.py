@@ -20,8 +20,22 @@
 # John DeNero (denero@cs.berkeley.edu) and Dan Klein (klein@cs.berkeley.edu).
 # For more info, see http://inst.eecs.berkeley.edu/~cs188/sp09/pacman.html
 
+import atexit
+import hashlib
+import heapq
+import json
+import mmap
+import multiprocessing
+import multiprocessing.connection
+import operator
+import os
 import random
+import struct
+import time
 import util
+import zlib
+from array import array
+from collections import OrderedDict, deque
 
 from capture_agents import CaptureAgent
 from game import Directions
@@ -33,7 +47,8 @@ from util import nearest_point
 #################
 
 def create_team(first_index, second_index, is_red,
-                first='HybridReflexAgent1', second='HybridReflexAgent2', num_training=0):
+                first='HybridReflexAgent1', second='HybridReflexAgent2', num_training=0,
+                search='0', search_time='', profile='', params='', trace='', distances='', workers=''):
     """
     This function should return a list of two agents that will form the
     team, initialized using firstIndex and secondIndex as their agent
@@ -48,7 +63,1934 @@ def create_team(first_index, second_index, is_red,
     any extra arguments, so you should make sure that the default
     behavior is what you want for the nightly contest.
     """
-    return [eval(first)(first_index), eval(second)(second_index)]
+    agents = [eval(first)(first_index), eval(second)(second_index)]
+    #params=<file> loads tuned weights and constants, as written by tune.py
+    if params:
+        with open(params) as f:
+            team_params = json.load(f)
+        for agent in agents:
+            agent.set_params(team_params)
+    #both agents share the maze, distance table and per-turn analysis
+    blackboard = TeamBlackboard()
+    #distances=table|lazy forces the all-pairs table or rows computed on demand
+    if distances:
+        if distances not in ('auto', 'table', 'lazy'):
+            raise ValueError('distances must be auto, table or lazy, not %s' % distances)
+        blackboard.distances = distances
+    #workers=<n> searches the root actions on n worker processes (with search=1)
+    if workers:
+        blackboard.workers = int(workers)
+    for agent in agents:
+        agent.blackboard = blackboard
+        #search='1' turns on the anytime lookahead, search_time is the
+        #fraction of the computing time per move it may use
+        agent.search_enabled = search.lower() in ('1', 'true', 'yes')
+        if search_time:
+            agent.search_time = float(search_time)
+        #profile=<directory> times the hot path and writes a summary per agent there
+        if profile:
+            agent.profiler = MoveProfiler(agent, profile)
+        #trace=<directory> records every turn of every game there, see TraceRecorder
+        if trace:
+            agent.recorder = TraceRecorder(trace)
+    return agents
+
+
+###############
+# Maze fields #
+###############
+
+UNREACHABLE = 0xFFFF
+
+#food and capsules are kept as integer bitsets over the cell ids of a MazeGraph
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(bits):
+        return bin(bits).count('1')
+
+
+def bit_cells(bits):
+    """
+    Cell ids of the set bits of a bitset, lowest first.
+    """
+    cells = []
+    while bits:
+        low = bits & -bits
+        cells.append(low.bit_length() - 1)
+        bits ^= low
+    return cells
+
+
+class MazeGraph:
+    """
+    Flat index over the open cells of a layout.  Cells are numbered column by
+    column, so per-cell data (distance fields, masks, ...) can be kept in plain
+    lists indexed by cell id instead of dicts keyed by position.
+    """
+
+    def __init__(self, walls):
+        self.width = walls.width
+        self.height = walls.height
+        self.cells = [(x, y) for x in range(self.width) for y in range(self.height) if not walls[x][y]]
+        self.cell_ids = {pos: i for i, pos in enumerate(self.cells)}
+        self.neighbors = []
+        for x, y in self.cells:
+            adjacent = ((x, y + 1), (x, y - 1), (x + 1, y), (x - 1, y))
+            self.neighbors.append(tuple(self.cell_ids[p] for p in adjacent if p in self.cell_ids))
+        #identifies the layout walls, used to key cached data on disk
+        digest = hashlib.sha1(('%dx%d:' % (self.width, self.height)).encode())
+        digest.update(bytes(bool(walls[x][y]) for x in range(self.width) for y in range(self.height)))
+        self.digest = digest.digest()
+
+    def __len__(self):
+        return len(self.cells)
+
+    def cell_id(self, pos):
+        return self.cell_ids[nearest_point(pos)]
+
+    def grid_bits(self, grid):
+        """
+        Bitset of the cells that are set in a game.Grid (food, ...).
+        """
+        return sum(1 << cell for cell, (x, y) in enumerate(self.cells) if grid[x][y])
+
+    def bfs(self, sources):
+        """
+        Multi-source breadth first search, returns the distance from every cell
+        to the closest of the source cells.
+        """
+        dist = [UNREACHABLE] * len(self.cells)
+        queue = deque()
+        for source in sources:
+            if dist[source] != 0:
+                dist[source] = 0
+                queue.append(source)
+        neighbors = self.neighbors
+        while queue:
+            cell = queue.popleft()
+            next_dist = dist[cell] + 1
+            for neighbor in neighbors[cell]:
+                if dist[neighbor] > next_dist:
+                    dist[neighbor] = next_dist
+                    queue.append(neighbor)
+        return dist
+
+
+class MazeTopology:
+    """
+    Where a pacman can get trapped.  Dead ends are found by repeatedly peeling
+    off cells with a single open neighbor: what gets peeled are corridors and
+    pockets with only one way out.  For every cell the index stores, in flat
+    arrays, how deep inside its dead end it is (0 outside dead ends) and the
+    exit, the nearest cell outside the dead end (itself outside dead ends),
+    plus which cells are articulation points (choke points whose removal
+    splits the maze).
+    """
+
+    def __init__(self, maze):
+        self.maze = maze
+        size = len(maze)
+        neighbors = maze.neighbors
+
+        degree = [len(n) for n in neighbors]
+        peeled = bytearray(size)
+        queue = deque(cell for cell in range(size) if degree[cell] <= 1)
+        while queue:
+            cell = queue.popleft()
+            if peeled[cell]:
+                continue
+            peeled[cell] = 1
+            for neighbor in neighbors[cell]:
+                if not peeled[neighbor]:
+                    degree[neighbor] -= 1
+                    if degree[neighbor] <= 1:
+                        queue.append(neighbor)
+        self.dead_end = peeled
+
+        #depth and exit by a breadth first search from the cells that stay
+        self.depth = array('H', [0] * size)
+        self.exit = array('H', range(size))
+        queue = deque(cell for cell in range(size) if not peeled[cell])
+        seen = bytearray(1 - p for p in peeled)
+        while queue:
+            cell = queue.popleft()
+            for neighbor in neighbors[cell]:
+                if not seen[neighbor]:
+                    seen[neighbor] = 1
+                    self.depth[neighbor] = self.depth[cell] + 1
+                    self.exit[neighbor] = self.exit[cell]
+                    queue.append(neighbor)
+
+        self.articulation = self.articulation_points(neighbors)
+
+    @staticmethod
+    def articulation_points(neighbors):
+        """
+        Tarjan's algorithm, iterative so large mazes do not hit the recursion limit.
+        """
+        size = len(neighbors)
+        order = [-1] * size
+        low = [0] * size
+        points = bytearray(size)
+        counter = 0
+        for root in range(size):
+            if order[root] >= 0:
+                continue
+            order[root] = low[root] = counter
+            counter += 1
+            root_children = 0
+            stack = [(root, -1, iter(neighbors[root]))]
+            while stack:
+                cell, parent, children = stack[-1]
+                for child in children:
+                    if order[child] < 0:
+                        order[child] = low[child] = counter
+                        counter += 1
+                        stack.append((child, cell, iter(neighbors[child])))
+                        break
+                    elif child != parent:
+                        low[cell] = min(low[cell], order[child])
+                else:
+                    stack.pop()
+                    if parent >= 0:
+                        low[parent] = min(low[parent], low[cell])
+                        if parent == root:
+                            root_children += 1
+                        elif low[cell] >= order[parent]:
+                            points[parent] = 1
+            if root_children > 1:
+                points[root] = 1
+        return points
+
+    def trap_risk(self, cell, chaser_distance):
+        """
+        How deep in a dead end cell is when a chaser, chaser_distance[exit]
+        steps from the exit, gets there no later than one step after us; 0
+        when the way out is safe.
+        """
+        depth = self.depth[cell]
+        if depth and chaser_distance[self.exit[cell]] <= depth + 1:
+            return depth
+        return 0
+
+
+class FoodDistanceField:
+    """
+    Distance from every cell to the nearest pellet, kept up to date as pellets
+    disappear (or are dropped back by a dying pacman) instead of being rebuilt.
+    """
+
+    def __init__(self, maze, food):
+        self.maze = maze
+        #bitset of the pellets the field is synchronized with
+        self.sources = food
+        self.dist = [UNREACHABLE] * len(maze)
+        self.nearest = [-1] * len(maze)
+        self._add(bit_cells(food))
+
+    def update(self, food):
+        """
+        Synchronizes the field with the current food bitset, only the cells
+        whose nearest pellet changed are touched.
+        """
+        removed = self.sources & ~food
+        added = food & ~self.sources
+        self.sources = food
+        if removed:
+            self._remove(set(bit_cells(removed)))
+        if added:
+            self._add(bit_cells(added))
+
+    def distance(self, pos, missing=0):
+        """
+        Maze distance from pos to the nearest pellet.  Pellets in the missing
+        bitset are ignored, which gives exact distances for states (a
+        successor, a search node) in which some of the field's pellets are gone.
+        """
+        cell = self.maze.cell_id(pos)
+        nearest = self.nearest[cell]
+        if nearest < 0 or not missing >> nearest & 1:
+            return self.dist[cell]
+        #the nearest pellet is gone, search outwards for the next one
+        present = self.sources & ~missing
+        seen = {cell}
+        queue = deque([(cell, 0)])
+        while queue:
+            current, d = queue.popleft()
+            if present >> current & 1:
+                return d
+            for neighbor in self.maze.neighbors[current]:
+                if neighbor not in seen:
+                    seen.add(neighbor)
+                    queue.append((neighbor, d + 1))
+        return UNREACHABLE
+
+    def _add(self, added):
+        dist, nearest, neighbors = self.dist, self.nearest, self.maze.neighbors
+        queue = deque()
+        for source in added:
+            dist[source] = 0
+            nearest[source] = source
+            queue.append(source)
+        while queue:
+            cell = queue.popleft()
+            next_dist = dist[cell] + 1
+            for neighbor in neighbors[cell]:
+                if dist[neighbor] > next_dist:
+                    dist[neighbor] = next_dist
+                    nearest[neighbor] = nearest[cell]
+                    queue.append(neighbor)
+
+    def _remove(self, removed):
+        dist, nearest, neighbors = self.dist, self.nearest, self.maze.neighbors
+        #cells that were closest to a removed pellet lose their distance
+        stale = [cell for cell in range(len(dist)) if nearest[cell] in removed]
+        for cell in stale:
+            dist[cell] = UNREACHABLE
+            nearest[cell] = -1
+        #and are refilled from the still valid cells around them
+        heap = []
+        for cell in stale:
+            for neighbor in neighbors[cell]:
+                if nearest[neighbor] != -1:
+                    heap.append((dist[neighbor] + 1, cell, nearest[neighbor]))
+        heapq.heapify(heap)
+        while heap:
+            d, cell, source = heapq.heappop(heap)
+            if d >= dist[cell]:
+                continue
+            dist[cell] = d
+            nearest[cell] = source
+            for neighbor in neighbors[cell]:
+                if dist[neighbor] > d + 1:
+                    heapq.heappush(heap, (d + 1, neighbor, source))
+
+
+DISTANCE_CACHE_DIR = os.environ.get('PACMAN_DISTANCE_CACHE',
+                                    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.distance_cache'))
+
+
+class MazeDistancer:
+    """
+    All-pairs maze distances stored as one flat integer table indexed by cell
+    id, using one byte per entry when the maze is small enough and two bytes
+    otherwise.  Tables are saved to DISTANCE_CACHE_DIR keyed by the layout
+    walls and memory-mapped on later games, so startup is a file map instead
+    of a breadth first search from every cell.
+
+    Exposes get_distance like the distance_calculator.Distancer it replaces.
+    """
+    #magic (includes byte order), typecode, cell count, crc32 of the table, layout digest
+    HEADER = struct.Struct('<8sc3xII20s')
+    MAGIC = b'PMDIST1' + (b'L' if struct.pack('=H', 1) == b'\x01\x00' else b'B')
+
+    def __init__(self, maze, table, typecode, source=None):
+        self.maze = maze
+        self.cell_ids = maze.cell_ids
+        self.size = len(maze)
+        self.table = table
+        self.unreachable = 0xFF if typecode == 'B' else 0xFFFF
+        #rows of byte tables are widened when some cell is unreachable, so
+        #every row marks unreachable cells with UNREACHABLE
+        self.widen_rows = typecode == 'B' and b'\xff' in table.cast('B').tobytes()
+        self._source = source
+
+    @classmethod
+    def for_maze(cls, maze, cache_dir=DISTANCE_CACHE_DIR):
+        """
+        Maps the cached table for this layout, computing (and caching) it when
+        there is no valid cache file.
+        """
+        path = None
+        if cache_dir:
+            path = os.path.join(cache_dir, maze.digest.hex() + '.dist')
+            try:
+                return cls.load(maze, path)
+            except (OSError, ValueError):
+                pass
+        distancer = cls.compute(maze)
+        if path is not None:
+            try:
+                distancer.save(path)
+            except OSError:
+                pass
+        return distancer
+
+    @classmethod
+    def compute(cls, maze):
+        rows = [maze.bfs([cell]) for cell in range(len(maze))]
+        longest = max([d for row in rows for d in row if d != UNREACHABLE] + [0])
+        typecode = 'B' if longest < 0xFF else 'H'
+        table = array(typecode)
+        for row in rows:
+            if typecode == 'B':
+                row = [0xFF if d == UNREACHABLE else d for d in row]
+            table.extend(row)
+        return cls(maze, memoryview(table), typecode, table)
+
+    @classmethod
+    def load(cls, maze, path):
+        """
+        Memory-maps a cached table, raises ValueError when the file does not
+        belong to this layout or fails the integrity check.
+        """
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if len(mapped) < cls.HEADER.size:
+                raise ValueError('truncated distance cache %s' % path)
+            magic, typecode, size, checksum, digest = cls.HEADER.unpack_from(mapped)
+            typecode = typecode.decode('ascii', 'replace')
+            if magic != cls.MAGIC or digest != maze.digest or size != len(maze) or typecode not in ('B', 'H'):
+                raise ValueError('distance cache %s does not match the layout' % path)
+            itemsize = array(typecode).itemsize
+            if len(mapped) != cls.HEADER.size + size * size * itemsize:
+                raise ValueError('distance cache %s has the wrong size' % path)
+            table = memoryview(mapped)[cls.HEADER.size:]
+            if zlib.crc32(table) != checksum:
+                table.release()
+                raise ValueError('distance cache %s is corrupt' % path)
+            return cls(maze, table.cast(typecode), typecode, mapped)
+        except ValueError:
+            mapped.close()
+            raise
+
+    def save(self, path):
+        """
+        Writes the table next to a temporary name first, so concurrent games
+        never map a half written file.
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        payload = self.table.cast('B')
+        header = self.HEADER.pack(self.MAGIC, self.table.format.encode('ascii'),
+                                  self.size, zlib.crc32(payload), self.maze.digest)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(header)
+                f.write(payload)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_distance(self, pos1, pos2):
+        try:
+            d = self.table[self.cell_ids[pos1] * self.size + self.cell_ids[pos2]]
+        except KeyError:
+            d = self.table[self.maze.cell_id(pos1) * self.size + self.maze.cell_id(pos2)]
+        return UNREACHABLE if d == self.unreachable else d
+
+    def row(self, cell):
+        """
+        Distances from one cell to every cell, as a read-only view on the table.
+        Unreachable cells are UNREACHABLE, as in the rows of LazyDistancer.
+        """
+        row = self.table[cell * self.size:(cell + 1) * self.size]
+        if self.widen_rows:
+            return array('H', [UNREACHABLE if d == 0xFF else d for d in row])
+        return row
+
+    def prefetch(self, cells, deadline):
+        #every row is in the table already
+        pass
+
+
+class LazyDistancer:
+    """
+    Maze distances for layouts too large for the all-pairs table: the row of
+    a source cell is computed by a breadth first search the first time it is
+    asked for and kept in a least recently used cache of at most max_bytes,
+    so memory grows with the sources the agents use (their spawn, the
+    opponents, ...) instead of with the square of the cell count.
+
+    Exposes get_distance and row like MazeDistancer.
+    """
+    #mazes with more open cells than this use lazy rows by default
+    AUTO_CELLS = 1500
+
+    def __init__(self, maze, max_bytes=16 << 20):
+        self.maze = maze
+        self.cell_ids = maze.cell_ids
+        self.size = len(maze)
+        self.max_rows = max(32, max_bytes // (2 * max(1, self.size)))
+        self.rows = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def row(self, cell):
+        """
+        Distances from one cell to every cell, unreachable cells are UNREACHABLE.
+        """
+        rows = self.rows
+        row = rows.get(cell)
+        if row is not None:
+            self.hits += 1
+            rows.move_to_end(cell)
+            return row
+        self.misses += 1
+        row = array('H', self.maze.bfs([cell]))
+        rows[cell] = row
+        if len(rows) > self.max_rows:
+            rows.popitem(last=False)
+        return row
+
+    def get_distance(self, pos1, pos2):
+        try:
+            cell1, cell2 = self.cell_ids[pos1], self.cell_ids[pos2]
+        except KeyError:
+            cell1, cell2 = self.maze.cell_id(pos1), self.maze.cell_id(pos2)
+        #distances are symmetric, so either cached row answers; callers pass
+        #the varying position (a successor) first and the source second
+        if cell1 in self.rows:
+            return self.row(cell1)[cell2]
+        return self.row(cell2)[cell1]
+
+    def prefetch(self, cells, deadline):
+        """
+        Computes the missing rows of cells that are likely sources next turn,
+        as long as time.perf_counter() is before deadline.
+        """
+        for cell in cells:
+            if time.perf_counter() >= deadline:
+                break
+            if cell not in self.rows:
+                self.row(cell)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'rows': len(self.rows), 'max_rows': self.max_rows, 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.}
+
+
+##############
+# Turn state #
+##############
+
+class SuccessorView:
+    """
+    The successor of one action together with the agent states the features
+    read from it, and the bitset of the food the agent attacks.
+    """
+    __slots__ = ('state', 'my_state', 'my_pos', 'enemies', 'invaders', 'food', 'food_count')
+
+    def __init__(self, agent, state, food):
+        self.state = state
+        self.my_state = state.get_agent_state(agent.index)
+        self.my_pos = self.my_state.get_position()
+        self.enemies = [state.get_agent_state(i) for i in agent.get_opponents(state)]
+        self.invaders = [a for a in self.enemies if a.is_pacman and a.get_position() is not None]
+        self.food = food
+        self.food_count = popcount(food)
+
+
+class GhostFields:
+    """
+    Distance from every cell to the nearest visible defender (danger) and to
+    the nearest visible ghost that stays scared long enough to be eaten
+    (attraction), built from rows of the distance table once per turn
+    instead of one distance lookup per defender, action and opponent.  The
+    states of a search only read a few cells, they look the distances up per
+    cell instead (whole_grid False).
+    """
+
+    #ghosts scared for more than this many moves are worth chasing
+    EATABLE = 5
+
+    def __init__(self, agent, opponents, whole_grid=True):
+        ghosts = [a for a in opponents if not a.is_pacman and a.get_position() is not None]
+        self.defenders = [a.get_position() for a in ghosts if a.scared_timer <= self.EATABLE]
+        self.scared = [a.get_position() for a in ghosts if a.scared_timer > self.EATABLE]
+        field = self.field if whole_grid else self.nearest
+        self.danger = field(agent, self.defenders)
+        self.attraction = field(agent, self.scared)
+
+    @staticmethod
+    def field(agent, positions):
+        if not positions:
+            return None
+        rows = [agent.distancer.row(agent.maze.cell_id(pos)) for pos in positions]
+        if len(rows) == 1:
+            return rows[0]
+        return list(map(min, *rows))
+
+    @staticmethod
+    def nearest(agent, positions):
+        if not positions:
+            return None
+        return NearestDistance(agent, positions)
+
+
+class NearestDistance:
+    """
+    Distance from a cell to the nearest of positions, indexed by cell like the
+    fields of GhostFields but computed only for the cells that are read.
+    """
+
+    __slots__ = ('agent', 'positions')
+
+    def __init__(self, agent, positions):
+        self.agent = agent
+        self.positions = positions
+
+    def __getitem__(self, cell):
+        pos = self.agent.maze.cells[cell]
+        get_distance = self.agent.distancer.get_distance
+        return min([get_distance(pos, source) for source in self.positions])
+
+
+class PelletRoute:
+    """
+    Ordered trip through the next pellets an agent eats and then to the home
+    boundary: the shortest such trip over the candidate pellets closest to
+    the agent, found by an exact search over their orderings.  The route is
+    kept across turns and followed as its pellets get eaten; it is only
+    planned again when one of its pellets disappears otherwise (the teammate
+    ate it), a defender shows up, or the trip got longer because the agent
+    delivered or died.
+    """
+
+    #pellets closest to the agent that a trip is planned over
+    CANDIDATES = 8
+
+    def __init__(self):
+        #cell ids of the pellets still to eat, in order
+        self.cells = []
+        self.defenders = ()
+        self.plans = 0
+
+    def clear(self):
+        self.cells = []
+        self.defenders = ()
+
+    def update(self, agent, snapshot, length):
+        """
+        Runs once per turn, length is the number of pellets the agent eats
+        before it turns back home.
+        """
+        food = snapshot.food
+        my_cell = agent.maze.cell_id(snapshot.my_state.get_position())
+        #the pellet the agent just ate is progress along the route
+        if self.cells and self.cells[0] == my_cell and not food >> my_cell & 1:
+            del self.cells[0]
+        #indices of the defenders in sight
+        defenders = tuple(i for i, a in zip(snapshot.opponent_indices, snapshot.opponents)
+                          if not a.is_pacman and a.get_position() is not None and a.scared_timer <= GhostFields.EATABLE)
+        length = max(0, min(length, popcount(food)))
+        if (len(self.cells) < length
+                or any(not food >> cell & 1 for cell in self.cells)
+                or any(i not in self.defenders for i in defenders)):
+            self.plan(agent, my_cell, food, length, snapshot.ghosts().danger)
+        del self.cells[length:]
+        self.defenders = defenders
+
+    def plan(self, agent, my_cell, food, length, danger):
+        self.plans += 1
+        self.cells = []
+        if length == 0:
+            return
+        row = agent.distancer.row(my_cell)
+        pellets = [cell for cell in bit_cells(food) if row[cell] != UNREACHABLE]
+        if danger is not None:
+            #pellets a defender reaches first are left out, unless that is all of them
+            pellets = [cell for cell in pellets if row[cell] < danger[cell]] or pellets
+        candidates = heapq.nsmallest(self.CANDIDATES, pellets, key=row.__getitem__)
+        length = min(length, len(candidates))
+        rows = dict((cell, agent.distancer.row(cell)) for cell in candidates)
+        home = agent.home_distance
+        #cost and order of the shortest trip found so far
+        best = [UNREACHABLE * (length + 2), []]
+
+        def visit(last, cost, route):
+            if cost >= best[0]:
+                return
+            if len(route) == length:
+                cost += home[last]
+                if cost < best[0]:
+                    best[0], best[1] = cost, list(route)
+                return
+            last_row = rows[last] if route else row
+            for cell in candidates:
+                if cell not in route:
+                    route.append(cell)
+                    visit(cell, cost + last_row[cell], route)
+                    route.pop()
+        visit(my_cell, 0, [])
+        self.cells = best[1]
+
+    def next_pellet(self, food):
+        """
+        The first pellet of the route that is still in the food bitset.
+        """
+        for cell in self.cells:
+            if food >> cell & 1:
+                return cell
+        return None
+
+    def ahead(self, food, count):
+        """
+        The first count pellets of the route that are still in the food bitset.
+        """
+        return tuple([cell for cell in self.cells if food >> cell & 1][:count])
+
+
+class TurnSnapshot:
+    """
+    Everything the features need that only depends on the current state.  It
+    is computed once per turn and shared by the evaluation of every legal
+    action, successors are generated once per action and cached.
+    """
+
+    def __init__(self, agent, game_state, whole_grid=True):
+        self.agent = agent
+        self.game_state = game_state
+        self.whole_grid = whole_grid
+        self.my_state = game_state.get_agent_state(agent.index)
+        self.food = agent.blackboard.food_bits(agent.get_food(game_state))
+        self.food_count = popcount(self.food)
+        self.opponent_indices = agent.get_opponents(game_state)
+        self.opponents = [game_state.get_agent_state(i) for i in self.opponent_indices]
+        self.score = agent.get_score(game_state)
+        self.on_own_side = agent.pacman_on_own_side(game_state)
+        self.max_scared_time = max([0] + [a.scared_timer for a in self.opponents if not a.is_pacman])
+        self.successors = {}
+        self._ghosts = None
+        #feature matrix, weight modes and defensive flag of the last batched
+        #evaluation of this state, the trace records them
+        self.evaluation = None
+
+    def ghosts(self):
+        if self._ghosts is None:
+            self._ghosts = GhostFields(self.agent, self.opponents, self.whole_grid)
+        return self._ghosts
+
+    def successor(self, action):
+        view = self.successors.get(action)
+        if view is None:
+            agent = self.agent
+            state = agent.get_successor(self.game_state, action)
+            if state.get_agent_state(agent.index).num_carrying < self.my_state.num_carrying:
+                #delivered or died, a dying pacman drops its pellets back
+                food = agent.blackboard.food_bits(agent.get_food(state))
+            else:
+                #a pacman eats the pellet on the cell it moves to
+                food = self.food & ~(1 << agent.maze.cell_id(state.get_agent_position(agent.index)))
+            view = SuccessorView(agent, state, food)
+            self.successors[action] = view
+        return view
+
+
+class SearchTimeout(Exception):
+    """
+    Raised inside the lookahead search once the turn's deadline has passed.
+    """
+    pass
+
+
+#############
+# Simulator #
+#############
+
+SCARED_TIME = 40    #same as capture.SCARED_TIME
+
+
+class ZobristKeys:
+    """
+    Random 64 bit keys for everything a SimState hash covers: the cell,
+    direction, pacman flag, scared timer and carried food of every agent,
+    every food and capsule cell, and the score.  The hash of a state is the XOR of the keys
+    of its contents.
+    """
+
+    def __init__(self, size, num_agents, seed=0):
+        self._rng = random.Random(seed)
+        key = lambda: self._rng.getrandbits(64)
+        #index 0 is the key of an agent we cannot see (cell -1)
+        self.cells = [[key() for cell in range(size + 1)] for i in range(num_agents)]
+        self.directions = [dict((d, key()) for d in (Directions.NORTH, Directions.SOUTH, Directions.EAST,
+                                                     Directions.WEST, Directions.STOP))
+                           for i in range(num_agents)]
+        self.scared = [[key() for timer in range(SCARED_TIME + 1)] for i in range(num_agents)]
+        self.carrying = [[key() for amount in range(size + 1)] for i in range(num_agents)]
+        self.food = [key() for cell in range(size)]
+        self.capsules = [key() for cell in range(size)]
+        #hidden opponents keep their flag, which the features still read
+        self.pacman = [key() for i in range(num_agents)]
+        self.scores = {}
+
+    def score(self, score):
+        if score not in self.scores:
+            self.scores[score] = self._rng.getrandbits(64)
+        return self.scores[score]
+
+    def bits(self, keys, bits):
+        h = 0
+        while bits:
+            low = bits & -bits
+            h ^= keys[low.bit_length() - 1]
+            bits ^= low
+        return h
+
+    def full(self, state):
+        h = self.bits(self.food, state.food) ^ self.bits(self.capsules, state.capsules) ^ self.score(state.score)
+        for i, cell in enumerate(state.cells):
+            h ^= self.cells[i][cell + 1] ^ self.directions[i][state.directions[i]]
+            h ^= self.scared[i][state.scared[i]] ^ self.carrying[i][state.carrying[i]]
+            if state.pacman[i]:
+                h ^= self.pacman[i]
+        return h
+
+    def without(self, h, state, index):
+        """
+        h with the cell and direction of agent index taken out.
+        """
+        return h ^ self.cells[index][state.cells[index] + 1] ^ self.directions[index][state.directions[index]]
+
+    def update(self, h, record, state):
+        """
+        Hash of state, given the hash h of the state stored in an undo record.
+        Only the keys of what changed are touched.
+        """
+        cells, directions, pacman, scared, carrying, food, capsules, score, old_hash = record
+        for i, cell in enumerate(state.cells):
+            if cell != cells[i]:
+                h ^= self.cells[i][cells[i] + 1] ^ self.cells[i][cell + 1]
+            if state.directions[i] != directions[i]:
+                h ^= self.directions[i][directions[i]] ^ self.directions[i][state.directions[i]]
+            if state.scared[i] != scared[i]:
+                h ^= self.scared[i][scared[i]] ^ self.scared[i][state.scared[i]]
+            if state.carrying[i] != carrying[i]:
+                h ^= self.carrying[i][carrying[i]] ^ self.carrying[i][state.carrying[i]]
+            if state.pacman[i] != pacman[i]:
+                h ^= self.pacman[i]
+        if state.food != food:
+            h ^= self.bits(self.food, state.food ^ food)
+        if state.capsules != capsules:
+            h ^= self.bits(self.capsules, state.capsules ^ capsules)
+        if state.score != score:
+            h ^= self.score(score) ^ self.score(state.score)
+        return h
+
+
+class TranspositionTable:
+    """
+    Search results keyed by position, with a hard cap on the number of
+    entries.  Every lookup refreshes an entry and the least recently used one
+    is evicted when the table is full; a result never replaces a deeper one
+    for the same position.  Entries are (depth, value, flag, best action).
+    """
+    EXACT, LOWER, UPPER = 0, 1, 2
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, depth, value, flag, best=None):
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] > depth:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = (depth, value, flag, best)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': self.hits / lookups if lookups else 0.0}
+
+
+class SimRules:
+    """
+    The static part of a simulated game: maze, teams, start cells and which
+    cells lie on the red side.  Shared by every SimState of one game.
+    """
+
+    def __init__(self, maze, game_state):
+        self.maze = maze
+        self.walls = game_state.get_walls()
+        self.num_agents = game_state.get_num_agents()
+        self.red_team = game_state.get_red_team_indices()
+        self.blue_team = game_state.get_blue_team_indices()
+        self.is_red = [i in self.red_team for i in range(self.num_agents)]
+        starts = [game_state.get_agent_state(i).start for i in range(self.num_agents)]
+        self.starts = [maze.cell_id(start.get_position()) for start in starts]
+        self.start_directions = [start.get_direction() for start in starts]
+        mid_x = maze.width // 2
+        self.red_side = [x < mid_x for x, y in maze.cells]
+        self.red_mask = sum(1 << cell for cell in range(len(maze)) if self.red_side[cell])
+        self.blue_mask = ((1 << len(maze)) - 1) ^ self.red_mask
+        #legal moves per cell, in the order of game.Actions (north, south, east, west, stop)
+        self.moves = []
+        for x, y in maze.cells:
+            targets = ((Directions.NORTH, (x, y + 1)), (Directions.SOUTH, (x, y - 1)),
+                       (Directions.EAST, (x + 1, y)), (Directions.WEST, (x - 1, y)))
+            moves = dict((d, maze.cell_ids[p]) for d, p in targets if p in maze.cell_ids)
+            moves[Directions.STOP] = maze.cell_ids[(x, y)]
+            self.moves.append(moves)
+        self.zobrist = ZobristKeys(len(maze), self.num_agents)
+
+    def bits_to_positions(self, bits):
+        cells = self.maze.cells
+        return [cells[cell] for cell in bit_cells(bits)]
+
+
+class SimConfiguration:
+    __slots__ = ('pos', 'direction')
+
+    def __init__(self, pos, direction):
+        self.pos = pos
+        self.direction = direction
+
+    def get_position(self):
+        return self.pos
+
+    def get_direction(self):
+        return self.direction
+
+
+class SimAgentState:
+    """
+    Read-only view with the fields of game.AgentState the features use.
+    """
+    __slots__ = ('configuration', 'is_pacman', 'scared_timer', 'num_carrying')
+
+    def __init__(self, configuration, is_pacman, scared_timer, num_carrying):
+        self.configuration = configuration
+        self.is_pacman = is_pacman
+        self.scared_timer = scared_timer
+        self.num_carrying = num_carrying
+
+    def get_position(self):
+        if self.configuration is None:
+            return None
+        return self.configuration.pos
+
+    def get_direction(self):
+        return self.configuration.direction
+
+
+class SimFood:
+    """
+    Read-only view on a food bitset with the part of game.Grid the agents use.
+    """
+    __slots__ = ('rules', 'bits')
+
+    def __init__(self, rules, bits):
+        self.rules = rules
+        self.bits = bits
+
+    def __eq__(self, other):
+        return isinstance(other, SimFood) and self.bits == other.bits
+
+    def as_list(self):
+        return self.rules.bits_to_positions(self.bits)
+
+    def count(self):
+        return popcount(self.bits)
+
+
+class SimState:
+    """
+    Compact game state for search.  Holds only what the features need (cells
+    of the agents, food and capsule bitsets, scared timers, carried food and
+    score) and follows the capture rules for moving, eating, scaring,
+    delivering and dying closely enough for lookahead.  Food carried by a
+    pacman that gets eaten is dropped on the free cells closest to where it
+    died, which is near but not always exactly where the real game puts it.
+
+    apply() moves an agent in place and returns a record for undo(), so a
+    search can walk the tree without copying.  hash is a Zobrist hash of the
+    state that apply() and undo() keep up to date incrementally.  generate_successor() and the
+    other getters mirror the capture GameState, so the reflex features can
+    evaluate a SimState as they would a real state.
+    """
+    __slots__ = ('rules', 'cells', 'directions', 'pacman', 'scared', 'carrying', 'food', 'capsules', 'score',
+                 'hash')
+
+    @classmethod
+    def from_game_state(cls, rules, game_state):
+        state = cls.__new__(cls)
+        state.rules = rules
+        maze = rules.maze
+        state.cells = []
+        state.directions = []
+        state.pacman = []
+        state.scared = []
+        state.carrying = []
+        for i in range(rules.num_agents):
+            agent_state = game_state.get_agent_state(i)
+            pos = agent_state.get_position()
+            state.cells.append(-1 if pos is None else maze.cell_id(pos))
+            state.directions.append(Directions.STOP if pos is None else agent_state.get_direction())
+            #kept apart from the cell, hidden opponents still tell whether they are pacman
+            state.pacman.append(agent_state.is_pacman)
+            state.scared.append(agent_state.scared_timer)
+            state.carrying.append(agent_state.num_carrying)
+        food = game_state.get_red_food().as_list() + game_state.get_blue_food().as_list()
+        state.food = sum(1 << maze.cell_ids[pos] for pos in food)
+        capsules = game_state.get_red_capsules() + game_state.get_blue_capsules()
+        state.capsules = sum(1 << maze.cell_ids[pos] for pos in capsules)
+        state.score = game_state.get_score()
+        state.hash = rules.zobrist.full(state)
+        return state
+
+    def fields(self):
+        """
+        Everything but the rules, to send a state to another process.
+        """
+        return (self.cells, self.directions, self.pacman, self.scared, self.carrying, self.food, self.capsules,
+                self.score, self.hash)
+
+    @classmethod
+    def from_fields(cls, rules, fields):
+        state = cls.__new__(cls)
+        state.rules = rules
+        (cells, directions, pacman, scared, carrying, state.food, state.capsules, state.score, state.hash) = fields
+        state.cells = list(cells)
+        state.directions = list(directions)
+        state.pacman = list(pacman)
+        state.scared = list(scared)
+        state.carrying = list(carrying)
+        return state
+
+    def copy(self):
+        state = SimState.__new__(SimState)
+        state.rules = self.rules
+        state.cells = self.cells[:]
+        state.directions = self.directions[:]
+        state.pacman = self.pacman[:]
+        state.scared = self.scared[:]
+        state.carrying = self.carrying[:]
+        state.food = self.food
+        state.capsules = self.capsules
+        state.score = self.score
+        state.hash = self.hash
+        return state
+
+    def apply(self, index, action):
+        """
+        Moves agent index in place and returns the record undo() needs.
+        """
+        record = (self.cells[:], self.directions[:], self.pacman[:], self.scared[:], self.carrying[:],
+                  self.food, self.capsules, self.score, self.hash)
+        rules = self.rules
+        cell = rules.moves[self.cells[index]][action]
+        self.cells[index] = cell
+        if action != Directions.STOP:
+            self.directions[index] = action
+        red = rules.is_red[index]
+        opponents = rules.blue_team if red else rules.red_team
+        self.pacman[index] = rules.red_side[cell] != red
+
+        if not self.pacman[index]:
+            #back home, deliver what we carry
+            if self.carrying[index] > 0:
+                self.score += self.carrying[index] if red else -self.carrying[index]
+                self.carrying[index] = 0
+            #a ghost eats the pacmen on its cell, or is eaten when scared
+            for other in opponents:
+                if self.cells[other] == cell and self.pacman[other]:
+                    if self.scared[index] <= 0:
+                        self._respawn(other)
+                    else:
+                        self._respawn(index)
+                        break
+        else:
+            bit = 1 << cell
+            if self.food & bit:
+                self.food ^= bit
+                self.carrying[index] += 1
+            if self.capsules & bit:
+                self.capsules ^= bit
+                for other in opponents:
+                    self.scared[other] = SCARED_TIME
+            #a pacman dies on a ghost's cell, unless the ghost is scared
+            for other in opponents:
+                if self.cells[other] == cell and not self.pacman[other]:
+                    if self.scared[other] <= 0:
+                        self._respawn(index)
+                        break
+                    else:
+                        self._respawn(other)
+
+        if self.scared[index] > 0:
+            self.scared[index] -= 1
+        self.hash = rules.zobrist.update(self.hash, record, self)
+        return record
+
+    def _respawn(self, index):
+        if self.carrying[index] > 0:
+            self._drop_food(self.cells[index], self.carrying[index])
+        self.cells[index] = self.rules.starts[index]
+        self.directions[index] = self.rules.start_directions[index]
+        self.pacman[index] = False
+        self.scared[index] = 0
+        self.carrying[index] = 0
+
+    def _drop_food(self, cell, amount):
+        #spreads the food over the closest free cells on the side it was eaten from
+        rules = self.rules
+        side = rules.red_side[cell]
+        occupied = self.food | self.capsules
+        for agent_cell in self.cells:
+            if agent_cell >= 0:
+                occupied |= 1 << agent_cell
+        seen = {cell}
+        queue = deque([cell])
+        while queue and amount > 0:
+            current = queue.popleft()
+            if not occupied >> current & 1:
+                self.food |= 1 << current
+                amount -= 1
+            for neighbor in rules.maze.neighbors[current]:
+                if neighbor not in seen and rules.red_side[neighbor] == side:
+                    seen.add(neighbor)
+                    queue.append(neighbor)
+
+    def undo(self, record):
+        (self.cells, self.directions, self.pacman, self.scared, self.carrying,
+         self.food, self.capsules, self.score, self.hash) = record
+
+    #the methods below mirror the capture GameState
+
+    def generate_successor(self, agent_index, action):
+        state = self.copy()
+        state.apply(agent_index, action)
+        return state
+
+    def get_legal_actions(self, agent_index=0):
+        return list(self.rules.moves[self.cells[agent_index]])
+
+    def get_agent_state(self, index):
+        cell = self.cells[index]
+        configuration = None
+        if cell >= 0:
+            configuration = SimConfiguration(self.rules.maze.cells[cell], self.directions[index])
+        return SimAgentState(configuration, self.pacman[index], self.scared[index], self.carrying[index])
+
+    def get_agent_position(self, index):
+        cell = self.cells[index]
+        return None if cell < 0 else self.rules.maze.cells[cell]
+
+    def get_num_agents(self):
+        return self.rules.num_agents
+
+    def get_red_food(self):
+        return SimFood(self.rules, self.food & self.rules.red_mask)
+
+    def get_blue_food(self):
+        return SimFood(self.rules, self.food & self.rules.blue_mask)
+
+    def get_red_capsules(self):
+        return self.rules.bits_to_positions(self.capsules & self.rules.red_mask)
+
+    def get_blue_capsules(self):
+        return self.rules.bits_to_positions(self.capsules & self.rules.blue_mask)
+
+    def get_red_team_indices(self):
+        return self.rules.red_team[:]
+
+    def get_blue_team_indices(self):
+        return self.rules.blue_team[:]
+
+    def is_on_red_team(self, agent_index):
+        return self.rules.is_red[agent_index]
+
+    def get_score(self):
+        return self.score
+
+    def get_walls(self):
+        return self.rules.walls
+
+    def is_over(self):
+        return False
+
+
+def cross_check_simulator(game_state, rollouts=20, steps=200, seed=0):
+    """
+    Plays random rollouts from game_state with generate_successor and checks
+    every step against SimState.apply (and its undo).  Every agent wanders to
+    random target cells so the rollouts cross the board and eat, deliver, get
+    scared and die.  Returns a list of (rollout, step, field, simulated, real)
+    mismatches; when a dying pacman drops its food only the number of
+    pellets is compared, not where they landed.
+    """
+    rng = random.Random(seed)
+    maze = MazeGraph(game_state.get_walls())
+    rules = SimRules(maze, game_state)
+    fields = {}
+    mismatches = []
+    for rollout in range(rollouts):
+        state = game_state
+        targets = [rng.randrange(len(maze)) for i in range(rules.num_agents)]
+        for step in range(steps):
+            index = step % rules.num_agents
+            cell = maze.cell_id(state.get_agent_position(index))
+            if cell == targets[index]:
+                targets[index] = rng.randrange(len(maze))
+            if targets[index] not in fields:
+                fields[targets[index]] = maze.bfs([targets[index]])
+            dist = fields[targets[index]]
+            actions = state.get_legal_actions(index)
+            if rng.random() < .8:
+                best = min(dist[rules.moves[cell][a]] for a in actions)
+                actions = [a for a in actions if dist[rules.moves[cell][a]] == best]
+            action = rng.choice(actions)
+            sim = SimState.from_game_state(rules, state)
+            before = sim.copy()
+            record = sim.apply(index, action)
+            state = state.generate_successor(index, action)
+            real = SimState.from_game_state(rules, state)
+            dropped = any(sim.cells[i] == rules.starts[i] != before.cells[i] for i in range(rules.num_agents))
+            if sim.hash != rules.zobrist.full(sim):
+                mismatches.append((rollout, step, 'hash', sim.hash, rules.zobrist.full(sim)))
+            for field in SimState.__slots__[1:-1]:
+                if field == 'food' and dropped and popcount(sim.food) == popcount(real.food):
+                    continue
+                if getattr(sim, field) != getattr(real, field):
+                    mismatches.append((rollout, step, field, getattr(sim, field), getattr(real, field)))
+            sim.undo(record)
+            for field in SimState.__slots__[1:]:
+                if getattr(sim, field) != getattr(before, field):
+                    mismatches.append((rollout, step, 'undo ' + field, getattr(sim, field), getattr(before, field)))
+    return mismatches
+
+
+##############
+# Blackboard #
+##############
+
+class OpponentBeliefs:
+    """
+    Where the opponents are likely to be while they are out of sight: one
+    probability per maze cell for every opponent.  Every turn the opponent
+    that just moved is spread over its possible moves, then each belief is
+    weighted by the noisy distance reading and cleared inside the team's
+    sight range.  A visible opponent collapses its belief to its cell.
+    """
+
+    #from capture.py: enemies within SIGHT_RANGE of any teammate are visible,
+    #distance readings are off by at most SONAR_NOISE (uniformly)
+    SIGHT_RANGE = 5
+    SONAR_NOISE = 6
+
+    def __init__(self, rules, opponents):
+        self.rules = rules
+        self.maze = rules.maze
+        self.xs = [x for x, y in self.maze.cells]
+        self.ys = [y for x, y in self.maze.cells]
+        self.targets = [tuple(moves.values()) for moves in rules.moves]
+        self.opponents = opponents
+        self.beliefs = dict((i, self.at_start(i)) for i in opponents)
+        #moves every opponent made since it was last seen, and how far every
+        #cell is from its start, to place it again after it respawned
+        self.unseen_moves = dict((i, 0) for i in opponents)
+        self.start_distance = dict((i, self.maze.bfs([rules.starts[i]])) for i in opponents)
+        #most likely cell of every opponent, refreshed by observe
+        self.modes = dict((i, rules.starts[i]) for i in opponents)
+        self.observed = False
+
+    def at_start(self, index):
+        belief = [0.] * len(self.maze)
+        belief[self.rules.starts[index]] = 1.
+        return belief
+
+    def around_start(self, index):
+        """
+        Uniform over the cells an opponent that respawned could have reached
+        since it was last seen.
+        """
+        moves = self.unseen_moves[index]
+        return [1. if d <= moves else 0. for d in self.start_distance[index]]
+
+    def observe(self, agent, game_state):
+        """
+        Folds in the observation one agent gets at the start of its turn.
+        """
+        mover = (agent.index - 1) % self.rules.num_agents
+        #agent 0 makes the first move of the game, nobody moved before it
+        if mover in self.beliefs and (self.observed or agent.index != 0):
+            self.beliefs[mover] = self.elapse(self.beliefs[mover])
+            self.unseen_moves[mover] += 1
+        self.observed = True
+
+        mx, my = game_state.get_agent_position(agent.index)
+        team = [game_state.get_agent_position(i) for i in agent.get_team(game_state)]
+        hidden = [all(abs(x - tx) + abs(y - ty) > self.SIGHT_RANGE for tx, ty in team)
+                  for x, y in self.maze.cells]
+        readings = game_state.get_agent_distances()
+        for i in self.opponents:
+            pos = game_state.get_agent_position(i)
+            if pos is not None:
+                belief = [0.] * len(self.maze)
+                belief[self.maze.cell_id(pos)] = 1.
+                self.unseen_moves[i] = 0
+            else:
+                belief = self.weigh(self.beliefs[i], mx, my, readings[i], hidden)
+                if belief is None:
+                    #the opponent cannot be where we thought, it was eaten
+                    #and respawned (or the belief is lost), start over from
+                    #every cell it reached from its start since it was last seen
+                    belief = self.weigh(self.around_start(i), mx, my, readings[i], hidden)
+                if belief is None:
+                    belief = self.weigh([1.] * len(self.maze), mx, my, readings[i], hidden)
+                if belief is None:
+                    belief = [1. / len(self.maze)] * len(self.maze)
+            self.beliefs[i] = belief
+            self.modes[i] = max(range(len(belief)), key=belief.__getitem__)
+
+    def elapse(self, belief):
+        """
+        One move of the opponent, every legal move (stop included) equally likely.
+        """
+        moved = [0.] * len(belief)
+        targets = self.targets
+        for cell, p in enumerate(belief):
+            if p:
+                cells = targets[cell]
+                share = p / len(cells)
+                for target in cells:
+                    moved[target] += share
+        return moved
+
+    def weigh(self, belief, mx, my, reading, hidden):
+        """
+        The belief times the likelihood of the reading, normalized, or None
+        when no cell is consistent with the reading.
+        """
+        low = reading - self.SONAR_NOISE
+        high = reading + self.SONAR_NOISE
+        weighed = [p if h and low <= abs(x - mx) + abs(y - my) <= high else 0.
+                   for p, x, y, h in zip(belief, self.xs, self.ys, hidden)]
+        total = sum(weighed)
+        if total <= 0:
+            return None
+        return [p / total for p in weighed]
+
+    def context(self, state):
+        """
+        The most likely cells of the invaders out of sight in a SimState, what
+        evaluations read from the beliefs.
+        """
+        return tuple(self.modes[i] for i in self.opponents if state.cells[i] < 0 and state.pacman[i])
+
+    def most_likely(self, index):
+        """
+        Most likely position of an opponent.
+        """
+        return self.maze.cells[self.modes[index]]
+
+    def expected_distance(self, index, pos, distancer):
+        """
+        Expected maze distance from pos to an opponent.
+        """
+        row = distancer.row(self.maze.cell_id(pos))
+        return sum(map(operator.mul, self.beliefs[index], row))
+
+
+class SearchPool:
+    """
+    Persistent worker processes that search the root actions of a turn in
+    parallel, the actions are split into one task per free worker.  The
+    all-pairs distance table is copied once into shared memory that the
+    workers map instead of being pickled to them.  Workers are forked from
+    the game process with their entry point, so only plain data goes over
+    their pipes: a task carries the root state and the agent's bookkeeping.
+    Where fork is not available there is no pool and the search stays serial.
+    """
+
+    @classmethod
+    def start(cls, processes, rules, distancer, red):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return None
+        return cls(processes, rules, distancer, red)
+
+    def __init__(self, processes, rules, distancer, red):
+        from multiprocessing import shared_memory
+        self.shared = None
+        table = None
+        if isinstance(distancer, MazeDistancer):
+            payload = distancer.table.cast('B')
+            self.shared = shared_memory.SharedMemory(create=True, size=max(1, len(payload)))
+            self.shared.buf[:len(payload)] = payload
+            table = (self.shared.name, distancer.table.format, len(payload))
+        context = multiprocessing.get_context('fork')
+        self.workers = []
+        self.connections = []
+        for i in range(processes):
+            connection, worker_connection = context.Pipe()
+            worker = context.Process(target=search_worker_main, args=(worker_connection, rules, table, red),
+                                     daemon=True)
+            worker.start()
+            worker_connection.close()
+            self.workers.append(worker)
+            self.connections.append(connection)
+        #a worker is busy until its last result was read, late results are dropped
+        self.busy = [False] * processes
+        atexit.register(self.close)
+
+    def free_workers(self):
+        """
+        Indices of the workers that can take a task now.
+        """
+        for i, connection in enumerate(self.connections):
+            if self.busy[i] and connection.poll():
+                self.receive(i)
+        return [i for i in range(len(self.connections)) if not self.busy[i]]
+
+    def receive(self, worker):
+        result = self.connections[worker].recv()
+        self.busy[worker] = False
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def submit(self, workers, tasks):
+        """
+        Starts one task on each of the given free workers.
+        """
+        for worker, task in zip(workers, tasks):
+            self.connections[worker].send(task)
+            self.busy[worker] = True
+
+    def collect(self, workers, deadline):
+        """
+        The results of the tasks submitted to workers, with None for those not
+        finished when time.time() reaches deadline.
+        """
+        waiting = dict((self.connections[worker], (position, worker)) for position, worker in enumerate(workers))
+        results = [None] * len(workers)
+        while waiting:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            for connection in multiprocessing.connection.wait(list(waiting), timeout):
+                position, worker = waiting.pop(connection)
+                results[position] = self.receive(worker)
+        return results
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+            worker.join()
+        for connection in self.connections:
+            connection.close()
+        self.workers = []
+        self.connections = []
+        self.busy = []
+        if self.shared is not None:
+            self.shared.close()
+            self.shared.unlink()
+            self.shared = None
+
+
+class SearchWorker:
+    """
+    The state of one pool process: the maze data of the team and a replica
+    of every agent it searched for, which keeps its transposition table
+    from turn to turn.
+    """
+
+    def __init__(self, rules, table, red):
+        self.rules = rules
+        if table is None:
+            distancer = LazyDistancer(rules.maze)
+        else:
+            from multiprocessing import shared_memory
+            name, typecode, size = table
+            self.shared = shared_memory.SharedMemory(name)
+            distancer = MazeDistancer(rules.maze, self.shared.buf[:size].cast(typecode), typecode, self.shared)
+        self.blackboard = TeamBlackboard()
+        self.blackboard.setup(red, rules, distancer)
+        self.blackboard.beliefs = OpponentBeliefs(rules, rules.blue_team if red else rules.red_team)
+        self.agents = {}
+
+    def agent(self, index, class_name, weights):
+        agent = self.agents.get(index)
+        if agent is None or type(agent).__name__ != class_name:
+            agent = globals()[class_name](index)
+            agent.blackboard = self.blackboard
+            agent.bind_blackboard()
+            self.agents[index] = agent
+        if agent.WEIGHTS != weights:
+            agent.WEIGHTS = weights
+            agent.feature_names, agent.weight_vectors = agent.compile_weights(weights)
+        return agent
+
+    def run(self, task):
+        """
+        Iterative deepening below some root actions until the deadline,
+        returns their values for every iteration that finished.
+        """
+        (index, class_name, weights, attributes, route, modes, food, fields, opponents, max_depth, deadline,
+         actions) = task
+        agent = self.agent(index, class_name, weights)
+        agent.__dict__.update(attributes)
+        agent.route.cells = list(route)
+        self.blackboard.beliefs.modes = modes
+        if agent.food_field.sources != food:
+            agent.food_field.update(food)
+        agent.snapshot = agent._scratch_snapshot = None
+        state = SimState.from_fields(self.rules, fields)
+        iterations = []
+        depth = 1
+        try:
+            while depth < max_depth:
+                values = []
+                for action in actions:
+                    record = state.apply(index, action)
+                    values.append(agent.min_value(state, opponents, depth, float('-inf'), float('inf'), deadline))
+                    state.undo(record)
+                iterations.append(values)
+                depth += 1
+        except SearchTimeout:
+            pass
+        return iterations
+
+
+def search_worker_main(connection, rules, table, red):
+    """
+    Main loop of a SearchPool process: runs the tasks it receives until the
+    pool closes the pipe.  Errors are sent back, the pool raises them.
+    """
+    worker = SearchWorker(rules, table, red)
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        try:
+            result = worker.run(task)
+        except Exception as e:
+            result = e
+        connection.send(result)
+
+
+class TeamBlackboard:
+    """
+    What the two agents of a team would otherwise both compute: the maze, its
+    distance table, the simulator rules and the food distance field are built
+    by whichever agent registers first.  Per-turn analysis is cached by the
+    content it was computed from, so the teammate (which sees a different
+    state) reuses it only while that content is unchanged.
+    """
+
+    #food grids whose bitsets are kept, a turn sees the current food and the
+    #food of the successors that deliver or die
+    food_cache_size = 8
+    #'table' for the all-pairs MazeDistancer, 'lazy' for a LazyDistancer,
+    #'auto' picks lazy rows for mazes above LazyDistancer.AUTO_CELLS cells
+    distances = 'auto'
+    #size of the SearchPool the lookahead uses, 0 searches serially
+    workers = 0
+
+    def __init__(self):
+        self.walls = None
+        self.maze = None
+        self.distancer = None
+        self.sim_rules = None
+        self.topology = None
+        self.red = None
+        self.home_side = None
+        self.home_distance = None
+        self.food_field = None
+        self.beliefs = None
+        self.search_pool = None
+        self._food_bits = []
+
+    def register(self, agent, game_state):
+        """
+        Called from register_initial_state by both agents, at the start of
+        every game.  The maze is only rebuilt when the layout changed.
+        """
+        walls = game_state.get_walls()
+        if self.walls is None or self.walls != walls or self.red != agent.red:
+            self.walls = walls
+            maze = MazeGraph(walls)
+            if self.distances == 'lazy' or (self.distances == 'auto' and len(maze) > LazyDistancer.AUTO_CELLS):
+                distancer = LazyDistancer(maze)
+            else:
+                distancer = MazeDistancer.for_maze(maze)
+            self.setup(agent.red, SimRules(maze, game_state), distancer)
+            self.close_search_pool()
+        if self.workers > 0 and agent.search_enabled and self.search_pool is None:
+            self.search_pool = SearchPool.start(self.workers, self.sim_rules, self.distancer, self.red)
+        self.food_field.update(self.food_bits(agent.get_food(game_state)))
+        if self.beliefs is None or self.beliefs.observed:
+            #a new game, the teammate may have registered already
+            self.beliefs = OpponentBeliefs(self.sim_rules, agent.get_opponents(game_state))
+
+    def setup(self, red, sim_rules, distancer):
+        """
+        Builds the per-layout data from the simulator rules and a distancer,
+        the food distance field starts out without pellets.
+        """
+        self.red = red
+        self.maze = sim_rules.maze
+        self.distancer = distancer
+        self.sim_rules = sim_rules
+        self.topology = MazeTopology(self.maze)
+        #which cells are the team's own side, and how far every cell is from it
+        self.home_side = bytearray(side == red for side in sim_rules.red_side)
+        self.home_distance = array('H', self.maze.bfs([cell for cell in range(len(self.maze)) if self.home_side[cell]]))
+        self._food_bits = []
+        self.food_field = FoodDistanceField(self.maze, 0)
+
+    def close_search_pool(self):
+        if self.search_pool is not None:
+            self.search_pool.close()
+            self.search_pool = None
+
+    def food_bits(self, food):
+        """
+        Bitset over the maze cells of a food grid, reused for grids equal to
+        one seen recently: comparing two grids is much cheaper than reading
+        one cell by cell.  Simulated food already is a bitset.
+        """
+        if isinstance(food, SimFood):
+            return food.bits
+        for i, (cached, bits) in enumerate(self._food_bits):
+            if cached == food:
+                if i:
+                    self._food_bits.insert(0, self._food_bits.pop(i))
+                return bits
+        bits = self.maze.grid_bits(food)
+        self._food_bits.insert(0, (food, bits))
+        del self._food_bits[self.food_cache_size:]
+        return bits
+
+
+#############
+# Profiling #
+#############
+
+class NullProfiler:
+    """
+    The profiler of agents that are not profiled, every hook does nothing.
+    """
+
+    def lap(self, group=None):
+        pass
+
+    def finish(self, game_state):
+        pass
+
+
+class MoveProfiler:
+    """
+    Wall time of the hot path of one agent: choose_action, get_successor,
+    get_maze_distance and the feature groups timed with lap().  The timed
+    methods are wrapped on the agent instance, so an agent without a
+    profiler runs the plain methods.  At the end of every game the latency
+    percentiles and the number of moves that came close to (or over)
+    time_for_computing are appended to a JSON file.
+    """
+
+    TIMED = ('choose_action', 'get_successor', 'get_maze_distance')
+
+    #a move counts as close to the limit above this part of time_for_computing
+    near_limit = .8
+
+    def __init__(self, agent, directory):
+        self.agent = agent
+        self.path = os.path.join(directory, 'profile_agent_%d.json' % agent.index)
+        self.samples = {}
+        self.games = []
+        self._lap = 0.
+        for name in self.TIMED:
+            setattr(agent, name, self.timed(name, getattr(agent, name)))
+
+    def samples_of(self, name):
+        samples = self.samples.get(name)
+        if samples is None:
+            samples = self.samples[name] = array('d')
+        return samples
+
+    def timed(self, name, method):
+        samples = self.samples_of(name)
+        clock = time.perf_counter
+
+        def timed_method(*args, **kwargs):
+            start = clock()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                samples.append(clock() - start)
+        return timed_method
+
+    def lap(self, group=None):
+        """
+        Time since the previous lap, recorded for the given feature group.
+        Without a group it only starts the clock.
+        """
+        now = time.perf_counter()
+        if group is not None:
+            self.samples_of('features.' + group).append(now - self._lap)
+        self._lap = now
+
+    @staticmethod
+    def percentiles(samples):
+        ordered = sorted(samples)
+
+        def at(q):
+            return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+        return {'count': len(ordered), 'total_ms': sum(ordered) * 1000,
+                'p50_ms': at(.5), 'p95_ms': at(.95), 'p99_ms': at(.99), 'max_ms': ordered[-1] * 1000}
+
+    def summary(self):
+        budget = self.agent.time_for_computing
+        moves = self.samples_of('choose_action')
+        maze = self.agent.maze
+        return {'layout': '%dx%d-%s' % (maze.width, maze.height, maze.digest.hex()[:12]),
+                'moves': len(moves),
+                'budget_ms': budget * 1000,
+                'near_limit': sum(1 for t in moves if t > self.near_limit * budget),
+                'over_limit': sum(1 for t in moves if t > budget),
+                'distances': self.agent.distancer.stats() if hasattr(self.agent.distancer, 'stats') else None,
+                'timings': dict((name, self.percentiles(samples))
+                                for name, samples in sorted(self.samples.items()) if samples)}
+
+    def finish(self, game_state):
+        """
+        Called from final: stores this game's summary and starts a new game.
+        """
+        self.games.append(self.summary())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, 'w') as f:
+            json.dump({'agent': self.agent.index, 'games': self.games}, f, indent=1)
+        for samples in self.samples.values():
+            del samples[:]
+
+
+###############
+# Game traces #
+###############
+
+TRACE_ACTIONS = (Directions.NORTH, Directions.SOUTH, Directions.EAST, Directions.WEST, Directions.STOP)
+
+
+class TraceFormat:
+    """
+    Layout of a trace file: a header, a JSON description and then one fixed
+    size record per turn of the agent.  A record holds the turn, the chosen
+    action, the agent's flags (pacman, defensive, scared timer, carried
+    food), the score, the time the move took, the cell of every agent (-1
+    when unseen), the food of both sides as a bitset over the maze cells and,
+    for every legal action, its weight mode, value and feature vector.
+    """
+
+    MAGIC = b'PMTRACE1'
+    HEADER = struct.Struct('<8sHHHHI20sI')
+    FIELDS = ('turn', 'action', 'num_actions', 'is_pacman', 'is_defensive', 'scared_timer',
+              'carrying', 'score', 'seconds')
+
+    def __init__(self, num_agents, num_cells, num_features):
+        self.num_agents = num_agents
+        self.num_cells = num_cells
+        self.num_features = num_features
+        self.food_bytes = (num_cells + 7) // 8
+        self.record = struct.Struct('<HBBBBBBhf%dh%ds%s' % (
+            num_agents, self.food_bytes, ('BBf%df' % num_features) * len(TRACE_ACTIONS)))
+
+    def pack_header(self, digest, description):
+        description = json.dumps(description).encode()
+        return self.HEADER.pack(self.MAGIC, self.num_agents, self.num_cells, self.num_features,
+                                len(TRACE_ACTIONS), self.record.size, digest, len(description)) + description
+
+
+class NullRecorder:
+    """
+    The recorder of agents that are not traced, every hook does nothing.
+    """
+
+    def record(self, agent, game_state, actions, values, action, start):
+        pass
+
+    def finish(self):
+        pass
+
+
+class TraceRecorder:
+    """
+    Writes one trace file per game for one agent, named after the process,
+    the game and the agent index.  Records are buffered in memory and
+    written out in large blocks, and at the end of the game.
+    """
+
+    #bytes buffered before they are written
+    buffer_size = 1 << 16
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.games = 0
+        self.path = None
+        self.format = None
+        self.modes = None
+        self.buffer = bytearray()
+        self.turn = 0
+
+    def start(self, agent, game_state):
+        self.format = TraceFormat(game_state.get_num_agents(), len(agent.maze), len(agent.feature_names))
+        self.modes = sorted(agent.weight_vectors)
+        self.turn = 0
+        description = {'agent': agent.index, 'red': agent.red, 'width': agent.maze.width,
+                       'height': agent.maze.height, 'features': list(agent.feature_names),
+                       'modes': self.modes, 'actions': list(TRACE_ACTIONS), 'fields': list(TraceFormat.FIELDS)}
+        os.makedirs(self.directory, exist_ok=True)
+        while True:
+            #teams created again in the same process must not overwrite earlier games
+            self.path = os.path.join(self.directory, 'trace_%d_%d_agent_%d.bin' % (os.getpid(), self.games, agent.index))
+            try:
+                with open(self.path, 'xb') as f:
+                    f.write(self.format.pack_header(agent.maze.digest, description))
+                return
+            except FileExistsError:
+                self.games += 1
+
+    def record(self, agent, game_state, actions, values, action, start):
+        """
+        Adds the turn of agent, start is the time.perf_counter() the move
+        started at, the recorded time includes the recording itself.
+        """
+        if self.path is None:
+            self.start(agent, game_state)
+        maze = agent.maze
+        snapshot = agent.snapshot
+        my_state = snapshot.my_state
+        cells = []
+        for i in range(self.format.num_agents):
+            pos = game_state.get_agent_position(i)
+            cells.append(-1 if pos is None else maze.cell_id(pos))
+        food = snapshot.food | agent.blackboard.food_bits(agent.get_food_you_are_defending(game_state))
+        if snapshot.evaluation is None:
+            #the actions were evaluated one at a time (batch_evaluation off)
+            matrix, modes = agent.feature_matrix(game_state, actions)
+            snapshot.evaluation = (matrix, modes, bool(getattr(agent, 'is_defensive', False)))
+        matrix, modes, is_defensive = snapshot.evaluation
+        slots = []
+        for i in range(len(TRACE_ACTIONS)):
+            if i < len(actions):
+                slots += [TRACE_ACTIONS.index(actions[i]), self.modes.index(modes[i]), values[i]] + matrix[i]
+            else:
+                slots += [255, 255, 0.] + [0.] * self.format.num_features
+        self.buffer += self.format.record.pack(
+            self.turn, TRACE_ACTIONS.index(action), len(actions), my_state.is_pacman,
+            is_defensive, min(255, my_state.scared_timer), min(255, my_state.num_carrying),
+            int(snapshot.score), time.perf_counter() - start,
+            *(cells + [food.to_bytes(self.format.food_bytes, 'little')] + slots))
+        self.turn += 1
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with open(self.path, 'ab') as f:
+                f.write(self.buffer)
+            del self.buffer[:]
+
+    def finish(self):
+        """
+        Called from final: writes what is buffered, the next game gets a new file.
+        """
+        if self.path is not None:
+            self.flush()
+            self.path = None
+            self.games += 1
+
+
+class TraceReader:
+    """
+    Memory maps a trace file written by TraceRecorder.  Records are decoded
+    on access, so scanning a file only touches the fields that are read;
+    column() unpacks one field of every record in a single pass.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = TraceFormat.HEADER
+        (magic, num_agents, num_cells, num_features, num_slots, record_size, self.digest,
+         description_size) = header.unpack_from(self.mapped)
+        if magic != TraceFormat.MAGIC or num_slots != len(TRACE_ACTIONS):
+            self.mapped.close()
+            raise ValueError('%s is not a trace file' % path)
+        self.description = json.loads(self.mapped[header.size:header.size + description_size].decode())
+        self.format = TraceFormat(num_agents, num_cells, num_features)
+        if self.format.record.size != record_size:
+            self.mapped.close()
+            raise ValueError('%s has records of %d bytes, expected %d' % (path, record_size, self.format.record.size))
+        self.offset = header.size + description_size
+        #a record cut off by an interrupted game is ignored
+        self.count = (len(self.mapped) - self.offset) // record_size
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        self.mapped.close()
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        values = self.format.record.unpack_from(self.mapped, self.offset + i * self.format.record.size)
+        return self.decode(values)
+
+    def __iter__(self):
+        view = memoryview(self.mapped)[self.offset:self.offset + self.count * self.format.record.size]
+        try:
+            for values in self.format.record.iter_unpack(view):
+                yield self.decode(values)
+        finally:
+            view.release()
+
+    def decode(self, values):
+        fields = len(TraceFormat.FIELDS)
+        record = dict(zip(TraceFormat.FIELDS, values[:fields]))
+        record['action'] = TRACE_ACTIONS[record['action']]
+        num_agents = self.format.num_agents
+        record['cells'] = values[fields:fields + num_agents]
+        food = values[fields + num_agents]
+        record['food'] = [cell for cell in range(self.format.num_cells) if food[cell >> 3] >> (cell & 7) & 1]
+        slots = values[fields + num_agents + 1:]
+        size = 3 + self.format.num_features
+        record['actions'] = []
+        for i in range(record['num_actions']):
+            slot = slots[i * size:(i + 1) * size]
+            record['actions'].append({'action': TRACE_ACTIONS[slot[0]], 'mode': self.description['modes'][slot[1]],
+                                      'value': slot[2],
+                                      'features': dict(zip(self.description['features'], slot[3:]))})
+        return record
+
+    def column(self, field):
+        """
+        One of the fixed fields (see TraceFormat.FIELDS) of every record.
+        """
+        index = TraceFormat.FIELDS.index(field)
+        view = memoryview(self.mapped)[self.offset:self.offset + self.count * self.format.record.size]
+        try:
+            return [values[index] for values in self.format.record.iter_unpack(view)]
+        finally:
+            view.release()
 
 
 ##########
@@ -60,43 +2002,172 @@ class ReflexCaptureAgent(CaptureAgent):
     A base class for reflex agents that choose score-maximizing actions
     """
 
+    #feature weights for every weight mode, see weight_mode
+    WEIGHTS = {'default': {'successor_score': 1.0}}
+
+    #score all legal actions at once through evaluate_actions,
+    #when false every action goes through evaluate (the reference path)
+    batch_evaluation = True
+
+    #anytime lookahead on top of the reflex evaluation (see search_values),
+    #search_time is the part of time_for_computing the search may use
+    search_enabled = False
+    search_time = .8
+    search_max_depth = 8
+    #positions searched in earlier turns are kept, up to this many entries
+    transposition_entries = 100000
+    #with a SearchPool, the part of time_for_computing left to collect the results
+    worker_margin = .1
+    #follow a planned PelletRoute to the food instead of the nearest pellet
+    route_planning = True
+    #a turn prefetches distance rows (LazyDistancer only) until this part of
+    #time_for_computing has passed since it started
+    prefetch_time = .5
+
+    #set by create_team, an agent created on its own gets a blackboard of its own
+    blackboard = None
+    #replaced by a MoveProfiler when the team option profile is given
+    profiler = NullProfiler()
+    #replaced by a TraceRecorder when the team option trace is given
+    recorder = NullRecorder()
+
     def __init__(self, index, time_for_computing=.1):
         super().__init__(index, time_for_computing)
+        self.time_for_computing = time_for_computing
+        self.feature_names, self.weight_vectors = self.compile_weights(self.WEIGHTS)
         self.start = None
+        self.maze = None
+        self.food_field = None
+        self.sim_rules = None
+        self.topology = None
+        self.home_side = None
+        self.home_distance = None
+        self.snapshot = None
+        self._scratch_snapshot = None
+        self.route = PelletRoute()
+        self.search_depths = []
+        self.transpositions = TranspositionTable(self.transposition_entries)
 
     def register_initial_state(self, game_state):
+        """
+        Same setup as CaptureAgent.register_initial_state, except that maze
+        distances come from the cached MazeDistancer table instead of a fresh
+        all-pairs search, and that the maze is shared with the teammate
+        through the blackboard.
+        """
         self.start = game_state.get_agent_position(self.index)
-        CaptureAgent.register_initial_state(self, game_state)
+        self.red = game_state.is_on_red_team(self.index)
+        self.register_team(self.get_team(game_state))
+        if self.blackboard is None:
+            self.blackboard = TeamBlackboard()
+        self.blackboard.register(self, game_state)
+        self.bind_blackboard()
+        #the start is a distance source every turn when food runs out
+        self.distancer.prefetch([self.maze.cell_id(self.start)], float('inf'))
+        self.route.clear()
+
+        import __main__
+        if '_display' in dir(__main__):
+            self.display = __main__._display
+
+    def bind_blackboard(self):
+        """
+        Takes the per-layout data over from the blackboard.
+        """
+        self.maze = self.blackboard.maze
+        self.distancer = self.blackboard.distancer
+        self.sim_rules = self.blackboard.sim_rules
+        self.topology = self.blackboard.topology
+        self.home_side = self.blackboard.home_side
+        self.home_distance = self.blackboard.home_distance
+        self.food_field = self.blackboard.food_field
 
     def choose_action(self, game_state):
         """
         Picks among the actions with the highest Q(s,a).
         """
+        start = time.perf_counter()
         actions = game_state.get_legal_actions(self.index)
 
-        # You can profile your evaluation time by uncommenting these lines
-        # start = time.time()
-        values = [self.evaluate(game_state, a) for a in actions]
-        # print 'eval time for agent %d: %.4f' % (self.index, time.time() - start)
+        #state level quantities are computed once, not once per action
+        self.snapshot = TurnSnapshot(self, game_state)
+        self.blackboard.beliefs.observe(self, game_state)
+        self.register_turn(self.snapshot)
+        #the field is shared, it is already up to date when the teammate
+        #moved last and no pellet was eaten or dropped since
+        if self.food_field.sources != self.snapshot.food:
+            self.food_field.update(self.snapshot.food)
+
+        #evaluation time is measured with the profile team option, see MoveProfiler
+        if self.search_enabled:
+            values = self.search_values(game_state, actions)
+        else:
+            values = self.action_values(game_state, actions)
 
         max_value = max(values)
         best_actions = [a for a, v in zip(actions, values) if v == max_value]
 
-        food_left = len(self.get_food(game_state).as_list())
+        food_left = self.snapshot.food_count
 
         if food_left <= 2:
-            best_dist = 9999
+            #deliver at the nearest home cell, then head back to the start
+            best_dist = (9999, 9999)
             best_action = None
             for action in actions:
-                successor = self.get_successor(game_state, action)
-                pos2 = successor.get_agent_position(self.index)
-                dist = self.get_maze_distance(self.start, pos2)
+                pos2 = self.snapshot.successor(action).my_pos
+                dist = (self.home_distance[self.maze.cell_id(pos2)], self.get_maze_distance(self.start, pos2))
                 if dist < best_dist:
                     best_action = action
                     best_dist = dist
-            return best_action
+        else:
+            best_action = random.choice(best_actions)
 
-        return random.choice(best_actions)
+        self.recorder.record(self, game_state, actions, values, best_action, start)
+        self.prefetch_distances(best_action, start + self.prefetch_time * self.time_for_computing)
+        return best_action
+
+    def prefetch_distances(self, action, deadline):
+        """
+        Spends what is left of the turn's prefetch time on the distance rows
+        the next turns are likely to ask for: the cell the agent moves to
+        and where the opponents most likely are.
+        """
+        cells = [self.maze.cell_id(self.snapshot.successor(action).my_pos)]
+        beliefs = self.blackboard.beliefs
+        cells += [self.maze.cell_id(beliefs.most_likely(i)) for i in self.snapshot.opponent_indices]
+        self.distancer.prefetch(cells, deadline)
+
+    def final(self, game_state):
+        #reports how deep the lookahead got, to tune search_time per machine
+        if self.search_depths:
+            depths = self.search_depths
+            print('agent %d search depth: min %d, mean %.2f, max %d over %d moves' % (
+                self.index, min(depths), sum(depths) / len(depths), max(depths), len(depths)))
+            #with a pool this is the table of the search in the game process, the workers keep their own
+            print('agent %d transposition table: %s' % (self.index, self.transpositions.stats()))
+        self.search_depths = []
+        self.profiler.finish(game_state)
+        self.recorder.finish()
+        CaptureAgent.final(self, game_state)
+
+    def set_params(self, params):
+        """
+        Replaces weights and constants with tuned values.  params['weights']
+        maps weight modes to the weights that change, params[<class name>]
+        maps attributes of the agent (threshold, maxfood, ...) to new values.
+        """
+        if 'weights' in params:
+            weights = dict((mode, dict(table)) for mode, table in self.WEIGHTS.items())
+            for mode, table in params['weights'].items():
+                if mode not in weights:
+                    raise ValueError('unknown weight mode %s' % mode)
+                weights[mode].update(table)
+            self.WEIGHTS = weights
+            self.feature_names, self.weight_vectors = self.compile_weights(self.WEIGHTS)
+        for name, value in params.get(type(self).__name__, {}).items():
+            if not hasattr(self, name):
+                raise ValueError('%s has no parameter %s' % (type(self).__name__, name))
+            setattr(self, name, value)
 
     def get_successor(self, game_state, action):
         """
@@ -110,6 +2181,230 @@ class ReflexCaptureAgent(CaptureAgent):
         else:
             return successor
 
+    def snapshot_of(self, game_state):
+        """
+        Returns the turn snapshot when game_state is the state of this turn.
+        Any other state (a search node) gets a scratch snapshot that is reused
+        for as long as the same state is being evaluated.
+        """
+        snapshot = self.snapshot
+        if snapshot is None or snapshot.game_state is not game_state:
+            snapshot = self._scratch_snapshot
+            if snapshot is None or snapshot.game_state is not game_state:
+                snapshot = self._scratch_snapshot = TurnSnapshot(self, game_state, whole_grid=False)
+        return snapshot
+
+    def food_distance(self, successor):
+        """
+        Maze distance from the successor position to the next pellet of the
+        planned route, or to the nearest pellet left in the successor, read
+        from the food distance field.
+        """
+        target = self.route.next_pellet(successor.food)
+        if target is not None:
+            return self.get_maze_distance(successor.my_pos, self.maze.cells[target])
+        return self.food_field.distance(successor.my_pos, self.food_field.sources & ~successor.food)
+
+    def evaluation_context(self, state, depth):
+        """
+        Whatever besides the game state the evaluation of state searched to
+        depth depends on (bookkeeping carried between turns), part of the
+        transposition table key.  The less it holds, the more entries of
+        earlier turns are reused.
+        """
+        return 0
+
+    def position_key(self, state):
+        """
+        Hash of state without the teammate, which stands still during the
+        search and is not read by the evaluation, so positions of an earlier
+        turn still hit after the teammate moved.
+        """
+        rules = state.rules
+        h = state.hash
+        for i in (rules.red_team if rules.is_red[self.index] else rules.blue_team):
+            if i != self.index:
+                h = rules.zobrist.without(h, state, i)
+        return h
+
+    def register_turn(self, snapshot):
+        """
+        Called once at the start of every turn, before any action is evaluated.
+        Bookkeeping that carries over between turns belongs here.
+        """
+        pass
+
+    #returns true when an agent is on its own side, therefore in ghost form
+    def pacman_on_own_side(self, game_state):
+        return self.home_side[self.maze.cell_id(game_state.get_agent_position(self.index))]
+
+    def action_values(self, game_state, actions):
+        """
+        Reflex values Q(s,a) of the given actions.
+        """
+        if self.batch_evaluation:
+            return self.evaluate_actions(game_state, actions)
+        return [self.evaluate(game_state, a) for a in actions]
+
+    def search_values(self, game_state, actions):
+        """
+        Iterative deepening alpha-beta over the agent's own moves and the
+        replies of the opponents it can see, with the reflex evaluation as the
+        leaf heuristic.  Depth 1 is the plain reflex evaluation, deeper
+        iterations walk a SimState in place with apply/undo.  Returns the root
+        values of the deepest iteration that finished before the deadline;
+        the depth reached is appended to search_depths.
+        """
+        deadline = time.time() + self.search_time * self.time_for_computing
+        values = self.action_values(game_state, actions)
+        root = SimState.from_game_state(self.sim_rules, game_state)
+        opponents = [i for i in self.get_opponents(game_state) if root.cells[i] >= 0]
+        pool = self.blackboard.search_pool
+        if pool is not None and len(actions) > 1:
+            try:
+                values, depth = self.parallel_search_values(pool, root, opponents, actions, values, deadline)
+                self.search_depths.append(depth)
+                return values
+            except Exception as e:
+                print('agent %d: search pool failed (%s: %s), searching serially' % (self.index, type(e).__name__, e))
+                #later games of the team search serially too instead of starting another pool
+                self.blackboard.workers = 0
+                self.blackboard.close_search_pool()
+        values, depth = self.deepen(root, opponents, actions, values, deadline)
+        self.search_depths.append(depth)
+        return values
+
+    def deepen(self, root, opponents, actions, values, deadline):
+        """
+        The iterations of search_values after depth 1, in this process.
+        Returns the values and depth of the deepest one finished in time.
+        """
+        depth = 1
+        try:
+            while depth < self.search_max_depth:
+                #best actions of the previous iteration first, for more cutoffs
+                order = sorted(range(len(actions)), key=lambda i: values[i], reverse=True)
+                deeper = list(values)
+                best = float('-inf')
+                for i in order:
+                    record = root.apply(self.index, actions[i])
+                    try:
+                        deeper[i] = self.min_value(root, opponents, depth, best, float('inf'), deadline)
+                    finally:
+                        #a timeout leaves the root as it was, the pool fallback searches it again
+                        root.undo(record)
+                    best = max(best, deeper[i])
+                values = deeper
+                depth += 1
+        except SearchTimeout:
+            pass
+        return values, depth
+
+    def parallel_search_values(self, pool, root, opponents, actions, values, deadline):
+        """
+        search_values on the worker pool: the root actions are split over the
+        free workers, each deepens its share without the cutoffs between
+        siblings, so the values are exact.  Meanwhile this process searches
+        all actions itself until the workers' deadline.  The values of the
+        deepest iteration every worker finished are returned with the depth,
+        unless the search here got at least as deep or a worker is late.
+        """
+        #the workers stop early enough for their results to arrive in time
+        worker_deadline = deadline - self.worker_margin * self.time_for_computing
+        task = (self.index, type(self).__name__, self.WEIGHTS, self.plain_attributes(), tuple(self.route.cells),
+                dict(self.blackboard.beliefs.modes), self.food_field.sources, root.fields(), opponents,
+                self.search_max_depth, worker_deadline)
+        workers = pool.free_workers()[:len(actions)]
+        if not workers:
+            return self.deepen(root, opponents, actions, values, deadline)
+        shares = [list(range(len(actions)))[i::len(workers)] for i in range(len(workers))]
+        pool.submit(workers, [task + (tuple(actions[i] for i in share),) for share in shares])
+        serial_values, serial_depth = self.deepen(root, opponents, actions, values, worker_deadline)
+        results = pool.collect(workers, deadline)
+        if any(result is None for result in results):
+            return serial_values, serial_depth
+        depth = min(len(result) for result in results)
+        if depth + 1 <= serial_depth:
+            return serial_values, serial_depth
+        values = list(values)
+        for share, result in zip(shares, results):
+            for i, value in zip(share, result[depth - 1]):
+                values[i] = value
+        return values, depth + 1
+
+    def plain_attributes(self):
+        """
+        The agent's attributes that are plain values (carried food, mode,
+        constants, ...), what a worker replica needs besides the weights.
+        """
+        return dict((name, value) for name, value in vars(self).items()
+                    if isinstance(value, (bool, int, float, str, tuple)))
+
+    #cutoffs are strict (< alpha, > beta), so values tied with the best are exact
+    #and choose_action can still break ties among equally good actions
+    #positions the agent has to move in are cached in the transposition table,
+    #keyed by the state hash and the agent's own bookkeeping (position_key, evaluation_context)
+    def max_value(self, state, opponents, depth, alpha, beta, deadline):
+        if time.time() > deadline:
+            raise SearchTimeout()
+        key = (self.position_key(state), self.evaluation_context(state, depth))
+        entry = self.transpositions.get(key)
+        best_action = None
+        if entry is not None:
+            entry_depth, entry_value, flag, best_action = entry
+            #only values searched to the same depth are reused, a deeper value
+            #would not be comparable with the siblings searched at this depth
+            if entry_depth == depth:
+                if (flag == TranspositionTable.EXACT or (flag == TranspositionTable.LOWER and entry_value > beta)
+                        or (flag == TranspositionTable.UPPER and entry_value < alpha)):
+                    return entry_value
+        actions = state.get_legal_actions(self.index)
+        if depth == 1:
+            #leaves are evaluated on a copy, the search keeps mutating state
+            value = max(self.action_values(state.copy(), actions))
+            self.transpositions.put(key, 1, value, TranspositionTable.EXACT)
+            return value
+        if best_action in actions:
+            #the best move found for this position earlier is tried first
+            actions.remove(best_action)
+            actions.insert(0, best_action)
+        alpha_orig = alpha
+        value = float('-inf')
+        for action in actions:
+            record = state.apply(self.index, action)
+            child_value = self.min_value(state, opponents, depth - 1, alpha, beta, deadline)
+            state.undo(record)
+            if child_value > value:
+                value = child_value
+                best_action = action
+            if value > beta:
+                break
+            alpha = max(alpha, value)
+        if value > beta:
+            flag = TranspositionTable.LOWER
+        elif value < alpha_orig:
+            flag = TranspositionTable.UPPER
+        else:
+            flag = TranspositionTable.EXACT
+        self.transpositions.put(key, depth, value, flag, best_action)
+        return value
+
+    def min_value(self, state, opponents, depth, alpha, beta, deadline, turn=0):
+        if turn == len(opponents):
+            return self.max_value(state, opponents, depth, alpha, beta, deadline)
+        if time.time() > deadline:
+            raise SearchTimeout()
+        opponent = opponents[turn]
+        value = float('inf')
+        for action in state.get_legal_actions(opponent):
+            record = state.apply(opponent, action)
+            value = min(value, self.min_value(state, opponents, depth, alpha, beta, deadline, turn + 1))
+            state.undo(record)
+            if value < alpha:
+                return value
+            beta = min(beta, value)
+        return value
+
     def evaluate(self, game_state, action):
         """
         Computes a linear combination of features and feature weights
@@ -118,6 +2413,42 @@ class ReflexCaptureAgent(CaptureAgent):
         weights = self.get_weights(game_state, action)
         return features * weights
 
+    @staticmethod
+    def compile_weights(weight_modes):
+        """
+        Turns the weight dictionaries into one fixed feature order and a weight
+        vector per mode, so scoring is a dot product instead of dict lookups.
+        """
+        names = tuple(sorted(set(name for weights in weight_modes.values() for name in weights)))
+        vectors = {mode: tuple(weights.get(name, 0) for name in names)
+                   for mode, weights in weight_modes.items()}
+        return names, vectors
+
+    def feature_matrix(self, game_state, actions):
+        """
+        The features of all actions as one matrix, a row per action in
+        feature_names order, and the weight mode of every row.
+        """
+        names = self.feature_names
+        matrix = []
+        modes = []
+        for action in actions:
+            features = self.get_features(game_state, action)
+            matrix.append([features.get(name, 0) for name in names])
+            #the mode is read right after get_features, which may switch is_defensive
+            modes.append(self.weight_mode(game_state))
+        return matrix, modes
+
+    def evaluate_actions(self, game_state, actions):
+        """
+        Batched version of evaluate, gives the same values.  The feature matrix
+        is multiplied with the precompiled weight vector of each row's mode.
+        """
+        matrix, modes = self.feature_matrix(game_state, actions)
+        self.snapshot_of(game_state).evaluation = (matrix, modes, bool(getattr(self, 'is_defensive', False)))
+        vectors = self.weight_vectors
+        return [sum(map(operator.mul, row, vectors[mode])) for row, mode in zip(matrix, modes)]
+
     def get_features(self, game_state, action):
         """
         Returns a counter of features for the state
@@ -132,74 +2463,69 @@ class ReflexCaptureAgent(CaptureAgent):
         Normally, weights do not depend on the game state.  They can be either
         a counter or a dictionary.
         """
-        return {'successor_score': 1.0}
+        return self.WEIGHTS[self.weight_mode(game_state)]
+
+    def weight_mode(self, game_state):
+        """
+        Names the entry of WEIGHTS that applies in this state.
+        """
+        return 'default'
 
 class HybridReflexAgent1(ReflexCaptureAgent):
     #initialize: - threshold (if the score goes above this number, the agent will become defensive)
     #            - food (the pellets the agent ate that has not been brought back yet)
     #            - maxfood (the number pellets an agent will eat before going back)
     #            - is_defensive (is true when the agent is defensive)
-    #            - last_food_count (will store how much pellets there were before the agent took its action)
     def __init__(self, index):
         super().__init__(index)
         self.threshold = 18
         self.food = 0
         self.maxfood = 2
         self.is_defensive = True
-        self.last_food_count = None
 
 
-    #returns true when an agent is on its own side, therefore in ghost form
-    def pacman_on_own_side(self,game_state):
-        mid_x = game_state.data.layout.width // 2
-        my_pos = game_state.get_agent_position(self.index)
-        if self.red:
-            return my_pos[0] < mid_x
-        else:
-            return my_pos[0] > mid_x
+    #the carried food decides when the agent turns defensive, so searched values depend on it,
+    #as do the route pellets it can reach within depth moves (the one after is the next target)
+    #and the believed positions of the invaders out of sight
+    def evaluation_context(self, state, depth):
+        return self.food, self.route.ahead(state.food, depth + 1), self.blackboard.beliefs.context(state)
+
+    #keeps track of the pellets the agent is carrying, runs once per turn
+    def register_turn(self, snapshot):
+        #the pellets the agent carries, they are delivered (back to 0) on its own side
+        self.food = snapshot.my_state.num_carrying
+
+        #plans the pellets to eat before going back (it goes back with more than maxfood)
+        if self.route_planning:
+            self.route.update(self, snapshot, self.maxfood + 1 - self.food)
 
 
     def get_features(self, game_state, action):
         features = util.Counter()
-        successor = self.get_successor(game_state, action)
+        self.profiler.lap()
+        snapshot = self.snapshot_of(game_state)
+        successor = snapshot.successor(action)
 
-        #Food from current state and the next
-        curr_food_list = self.get_food(game_state).as_list()
-        food_list = self.get_food(successor).as_list()
+        #Food in the next state
+        food_left = successor.food_count
 
         #Agent state and scared timer
-        my_state = game_state.get_agent_state(self.index)
-        my_scared_timer = my_state.scared_timer
-
-        #initialize last_food_count
-        if self.last_food_count is None:
-            self.last_food_count = len(curr_food_list)
-
-        #if agent ate a pellet, add to own food count
-        food_eaten = self.last_food_count - len(curr_food_list)
-        if food_eaten > 0:
-            self.food += food_eaten
+        my_scared_timer = snapshot.my_state.scared_timer
 
-        #update global food count
-        self.last_food_count = len(curr_food_list)
 
 
+        self.profiler.lap('successor')
 
         # defensive features
-        my_state = successor.get_agent_state(self.index)
-        my_pos = my_state.get_position()
-
-        #when the agent is on its own side, it delivers eaten pellets
-        if self.pacman_on_own_side(game_state):
-            self.food = 0
+        my_state = successor.my_state
+        my_pos = successor.my_pos
 
         # Computes whether we're on defense (1) or offense (0)
         features['on_defense'] = 1
         if my_state.is_pacman: features['on_defense'] = 0
 
         # Computes distance to invaders we can see
-        enemies = [successor.get_agent_state(i) for i in self.get_opponents(successor)]
-        invaders = [a for a in enemies if a.is_pacman and a.get_position() is not None]
+        invaders = successor.invaders
         # Reducing number of invaders has a high priority
         features['num_invaders'] = len(invaders)
         if len(invaders) > 0:
@@ -209,146 +2535,161 @@ class HybridReflexAgent1(ReflexCaptureAgent):
             if min(dists) < 10:
                 #used when scared
                 features['flee'] = 1
-
-        #computes distance to start position
+        else:
+            #invaders out of sight are chased to where they most likely are
+            hidden = [i for i, a in zip(snapshot.opponent_indices, snapshot.opponents)
+                      if a.is_pacman and a.get_position() is None]
+            if len(hidden) > 0:
+                beliefs = self.blackboard.beliefs
+                dists = [self.get_maze_distance(my_pos, beliefs.most_likely(i)) for i in hidden]
+                features['invader_belief_distance'] = min(dists)
+
+        #computes distance to the nearest cell of the own side
         #is used to find path back to own side
-        disttostart = self.get_maze_distance(my_pos, self.start)
         if my_state.is_pacman:
-            features['distance_to_start'] = disttostart
+            features['distance_to_home'] = self.home_distance[self.maze.cell_id(my_pos)]
         else:
-            features['distance_to_start'] = 0
+            features['distance_to_home'] = 0
 
         #is used to punish standing still and repeating moves
         if action == Directions.STOP: features['stop'] = 1
-        rev = Directions.REVERSE[game_state.get_agent_state(self.index).configuration.direction]
+        rev = Directions.REVERSE[snapshot.my_state.configuration.direction]
         if action == rev: features['reverse'] = 1
 
 
 
+        self.profiler.lap('defensive')
+
         #offensive features
 
         #to make agents eat food, we make them want to reduce the amount of food
-        features['successor_score'] = -len(food_list)
-
-        #path finding to nearest pellet
-        if len(food_list) > 0:
-            my_pos = successor.get_agent_state(self.index).get_position()
-            min_distance = min([self.get_maze_distance(my_pos, food) for food in food_list])
-            features['distance_to_food'] = min_distance
-
-        #determines if defenders are scared or not
-        opponents = self.get_opponents(game_state)
-        max_scared_time = 0
-        closest_scared_ghost_dist = float('inf')
-        for opponent in opponents:
-            ghost_state = game_state.get_agent_state(opponent)
-            if not ghost_state.is_pacman:  # ghost
-                scared_timer = ghost_state.scared_timer
-                max_scared_time = max(max_scared_time, scared_timer)
-                #if the defender will be scared for more than 5 rounds, try to eat him
-                if scared_timer > 5:
-                    ghost_pos = ghost_state.get_position()
-                    if ghost_pos:
-                        dist = self.get_maze_distance(my_pos, ghost_pos)
-                        closest_scared_ghost_dist = min(closest_scared_ghost_dist, dist)
-                        features['distance_to_scared_ghost'] = closest_scared_ghost_dist
-                #if not, keep distance/run away depending how close ghost is
-                else:
-                    features['distance_to_scared_ghost'] = 0
-                    defenders = [a for a in enemies if not a.is_pacman and a.get_position() is not None]
-
-                    if len(defenders) > 0:
-                        dists = [self.get_maze_distance(my_pos, a.get_position()) for a in defenders]
-                        mindist = min(dists)
-                        if mindist < 3:
-                            #ghost_really_close returns a higher number when a ghost is closer
-                            #we combine this with a high penalty
-                            features['ghost_really_close'] = 3 - mindist
-                            features['getoutofthere'] = 1
-                        elif mindist < 8:
-                            features['getoutofthere'] = 1
-                            features['ghost_close'] = mindist
-                        else:
-                            features['ghost_far'] = mindist
-
-        features['scared_ghost_time'] = max_scared_time
+        features['successor_score'] = -food_left
+
+        #path finding to the next pellet of the planned route, or the nearest one
+        if food_left > 0:
+            features['distance_to_food'] = self.food_distance(successor)
+
+        self.profiler.lap('food')
+
+        #the distance fields of the visible ghosts are computed once per state (see GhostFields)
+        ghosts = snapshot.ghosts()
+        my_cell = self.maze.cell_id(my_pos)
+
+        #if a defender will be scared for more than 5 rounds, try to eat him
+        if ghosts.scared:
+            features['distance_to_scared_ghost'] = ghosts.attraction[my_cell]
+
+        #if not, keep distance/run away depending how close ghost is
+        if ghosts.defenders:
+            mindist = ghosts.danger[my_cell]
+            if mindist < 3:
+                #ghost_really_close returns a higher number when a ghost is closer
+                #we combine this with a high penalty
+                features['ghost_really_close'] = 3 - mindist
+                features['getoutofthere'] = 1
+            elif mindist < 8:
+                features['getoutofthere'] = 1
+                features['ghost_close'] = mindist
+            else:
+                features['ghost_far'] = mindist
+
+            #a dead end the defenders can close off before the agent is out again
+            features['trap_risk'] = self.topology.trap_risk(my_cell, ghosts.danger)
+
+        features['scared_ghost_time'] = snapshot.max_scared_time
+        self.profiler.lap('ghosts')
 
         #agent acts defensive when: -total game score is high enough,
         #                           -it is holding enough pellets (to bring them home)
         #                           -it sees an invader when returning home
         #it turns offensive when the enemy eats a power pellet
-        if (self.get_score(game_state) >= self.threshold or self.food > self.maxfood) and my_scared_timer == 0:
+        if (snapshot.score >= self.threshold or self.food > self.maxfood) and my_scared_timer == 0:
             self.is_defensive = True
-        elif self.pacman_on_own_side(game_state) and len(invaders) > 0:
+        elif snapshot.on_own_side and len(invaders) > 0:
             self.is_defensive = True
         else:
             self.is_defensive = False
+        self.profiler.lap('mode')
 
 
         return features
 
     #weights will change depending on the state of the agent (defensive/offensive, pacman/ghost, scared/not scared)
+    #the weight tables live in WEIGHTS, weight_mode picks the one that applies
     def get_weights(self, game_state, action):
-        my_state = game_state.get_agent_state(self.index)
+        return self.WEIGHTS[self.weight_mode(game_state)]
+
+    def weight_mode(self, game_state):
+        my_state = self.snapshot_of(game_state).my_state
         my_scared_timer = my_state.scared_timer
-        #when the agent is pacman and becomes defensive, it will: - avoid ghosts
-        #                                                         - try to go to its own side
-        #                                                         - already try to eat invaders
         if self.is_defensive and my_state.is_pacman:
-            #defensive weights
-            return {'on_defense': 100,
-                    'invader_distance': -500,
-                    'stop': -200,
-                    'reverse': -1,
-                    'distance_to_start': -30,
-                    'ghost_really_close': -500,
-                    'ghost_close': 100,
-                    'getoutofthere': -100
-                    }
-        #when the agent is a ghost, defensive and scared, it will try to stay at a safe distance from invaders
+            return 'defensive_pacman'
         elif self.is_defensive and not my_state.is_pacman:
             if my_scared_timer > 0:
-                return {'flee': -500,
-                        'stop': -200,
-                        'reverse': -1
-                        }
-            #when not scared, it will: - try to reduce the number of invaders (very high priority)
-            #                          - reduce distance to the closest invader
+                return 'scared_ghost'
             else:
-                return {
-                    'num_invaders': -5000,
-                    'on_defense': 100,
-                    'invader_distance': -500,
-                    'stop': -200,
-                    'reverse': -1
-                }
+                return 'defensive_ghost'
+        elif not self.is_defensive and not my_state.is_pacman:
+            return 'offensive_ghost'
+        else:
+            return 'offensive_pacman'
+
+    WEIGHTS = {
+        #when the agent is pacman and becomes defensive, it will: - avoid ghosts
+        #                                                         - try to go to its own side
+        #                                                         - already try to eat invaders
+        #                                                         - stay out of dead ends a ghost can close off
+        'defensive_pacman': {'on_defense': 100,
+                             'invader_distance': -500,
+                             'stop': -200,
+                             'reverse': -1,
+                             'distance_to_home': -30,
+                             'ghost_really_close': -500,
+                             'ghost_close': 100,
+                             'getoutofthere': -100,
+                             'trap_risk': -200
+                             },
+        #when the agent is a ghost, defensive and scared, it will try to stay at a safe distance from invaders
+        'scared_ghost': {'flee': -500,
+                         'stop': -200,
+                         'reverse': -1
+                         },
+        #when not scared, it will: - try to reduce the number of invaders (very high priority)
+        #                          - reduce distance to the closest invader
+        #                          - head for where unseen invaders most likely are
+        'defensive_ghost': {'num_invaders': -5000,
+                            'on_defense': 100,
+                            'invader_distance': -500,
+                            'invader_belief_distance': -10,
+                            'stop': -200,
+                            'reverse': -1
+                            },
         #the weights of an offensive ghost and an offensive pacman only differ in how much they want to avoid defenders
         #a ghost cannot be eaten, but it does try to avoid running into a defender when it changes to pacman
-        #a pacman gives highest priority to running away from ghosts
+        #a pacman gives highest priority to running away from ghosts, and not into a dead end they can close off
         #besides this, it will: - try to eat pellets
         #                       - try to reduce the distance to pellets
         #                       - try to eat scared ghosts
-        elif not self.is_defensive and not my_state.is_pacman:
-            #offensive weights
-            return {'successor_score': 100,
-                    'distance_to_food': -2,
-                    'ghost_really_close': -200,
-                    'ghost_close': 50,
-                    'stop': -200,
-                    'ghost_far': 20,
-                    'getoutofthere': -100,
-                    'distance_to_scared_ghost': -500
-                    }
-        else:
-            return {'successor_score': 100,
-                    'distance_to_food': -2,
-                    'ghost_really_close': -2000,
-                    'ghost_close': 200,
-                    'stop': -200,
-                    'ghost_far': 500,
-                    'getoutofthere': -100,
-                    'distance_to_scared_ghost': -500
-                    }
+        'offensive_ghost': {'successor_score': 100,
+                            'distance_to_food': -2,
+                            'ghost_really_close': -200,
+                            'ghost_close': 50,
+                            'stop': -200,
+                            'ghost_far': 20,
+                            'getoutofthere': -100,
+                            'distance_to_scared_ghost': -500
+                            },
+        'offensive_pacman': {'successor_score': 100,
+                             'distance_to_food': -2,
+                             'ghost_really_close': -2000,
+                             'ghost_close': 200,
+                             'stop': -200,
+                             'ghost_far': 500,
+                             'getoutofthere': -100,
+                             'distance_to_scared_ghost': -500,
+                             'trap_risk': -200
+                             },
+    }
 
 #HybridReflexAgent2 is almost the same as HybridReflexAgent1, further comments will indicate differences
 class HybridReflexAgent2(ReflexCaptureAgent):
@@ -358,126 +2699,109 @@ class HybridReflexAgent2(ReflexCaptureAgent):
         self.food = 0
         self.maxfood = 3        #this agent is more greedy, it will eat 3 pellets instead of 2 before returning home
         self.is_defensive = True
-        self.last_food_count = None
 
 
-    def pacman_on_own_side(self,game_state):
-        mid_x = game_state.data.layout.width // 2
-        my_pos = game_state.get_agent_position(self.index)
-        if self.red:
-            return my_pos[0] < mid_x
-        else:
-            return my_pos[0] > mid_x
+    def evaluation_context(self, state, depth):
+        return self.food, self.route.ahead(state.food, depth + 1), self.blackboard.beliefs.context(state)
 
+    def register_turn(self, snapshot):
+        self.food = snapshot.my_state.num_carrying
 
-    def get_features(self, game_state, action):
-        features = util.Counter()
-        successor = self.get_successor(game_state, action)
+        if self.route_planning:
+            self.route.update(self, snapshot, self.maxfood + 1 - self.food)
 
-        #Food from current state and the next
-        curr_food_list = self.get_food(game_state).as_list()
-        food_list = self.get_food(successor).as_list()
 
-        my_state = game_state.get_agent_state(self.index)
-        my_scared_timer = my_state.scared_timer
+    def get_features(self, game_state, action):
+        features = util.Counter()
+        self.profiler.lap()
+        snapshot = self.snapshot_of(game_state)
+        successor = snapshot.successor(action)
 
-        #initialize last_food_count
-        if self.last_food_count is None:
-            self.last_food_count = len(curr_food_list)
+        #Food in the next state
+        food_left = successor.food_count
 
-        #if agent ate a pellet, add to own food count
-        food_eaten = self.last_food_count - len(curr_food_list)
-        if food_eaten > 0:
-            self.food += food_eaten
+        my_scared_timer = snapshot.my_state.scared_timer
 
-        #update global food count
-        self.last_food_count = len(curr_food_list)
 
 
+        self.profiler.lap('successor')
 
         # defensive features
-        my_state = successor.get_agent_state(self.index)
-        my_pos = my_state.get_position()
-
-
-        if self.pacman_on_own_side(game_state):
-            self.food = 0
+        my_state = successor.my_state
+        my_pos = successor.my_pos
 
         # Computes whether we're on defense (1) or offense (0)
         features['on_defense'] = 1
         if my_state.is_pacman: features['on_defense'] = 0
 
         # Computes distance to invaders we can see
-        enemies = [successor.get_agent_state(i) for i in self.get_opponents(successor)]
-        invaders = [a for a in enemies if a.is_pacman and a.get_position() is not None]
+        invaders = successor.invaders
         features['num_invaders'] = len(invaders)
         if len(invaders) > 0:
             dists = [self.get_maze_distance(my_pos, a.get_position()) for a in invaders]
             features['invader_distance'] = min(dists)
             if min(dists) < 10:
                 features['flee'] = 1
-
-        #computes distance to start position
-        disttostart = self.get_maze_distance(my_pos, self.start)
+        else:
+            hidden = [i for i, a in zip(snapshot.opponent_indices, snapshot.opponents)
+                      if a.is_pacman and a.get_position() is None]
+            if len(hidden) > 0:
+                beliefs = self.blackboard.beliefs
+                dists = [self.get_maze_distance(my_pos, beliefs.most_likely(i)) for i in hidden]
+                features['invader_belief_distance'] = min(dists)
+
+        #computes distance to the nearest cell of the own side
         if my_state.is_pacman:
-            features['distance_to_start'] = disttostart
+            features['distance_to_home'] = self.home_distance[self.maze.cell_id(my_pos)]
         else:
-            features['distance_to_start'] = 0
+            features['distance_to_home'] = 0
 
         if action == Directions.STOP: features['stop'] = 1
-        rev = Directions.REVERSE[game_state.get_agent_state(self.index).configuration.direction]
+        rev = Directions.REVERSE[snapshot.my_state.configuration.direction]
         if action == rev: features['reverse'] = 1
 
 
+        self.profiler.lap('defensive')
+
         #offensive features
 
-        features['successor_score'] = -len(food_list)
-
-        if len(food_list) > 0:
-            my_pos = successor.get_agent_state(self.index).get_position()
-            min_distance = min([self.get_maze_distance(my_pos, food) for food in food_list])
-            features['distance_to_food'] = min_distance
-
-
-        opponents = self.get_opponents(game_state)
-        max_scared_time = 0
-        closest_scared_ghost_dist = float('inf')
-        for opponent in opponents:
-            ghost_state = game_state.get_agent_state(opponent)
-            if not ghost_state.is_pacman:  # spook
-                scared_timer = ghost_state.scared_timer
-                max_scared_time = max(max_scared_time, scared_timer)
-                if scared_timer > 5:
-                    ghost_pos = ghost_state.get_position()
-                    if ghost_pos:
-                        dist = self.get_maze_distance(my_pos, ghost_pos)
-                        closest_scared_ghost_dist = min(closest_scared_ghost_dist, dist)
-                        features['distance_to_scared_ghost'] = closest_scared_ghost_dist
-                else:
-                    features['distance_to_scared_ghost'] = 0
-                    defenders = [a for a in enemies if not a.is_pacman and a.get_position() is not None]
+        features['successor_score'] = -food_left
+
+        if food_left > 0:
+            features['distance_to_food'] = self.food_distance(successor)
+
+        self.profiler.lap('food')
+
+        ghosts = snapshot.ghosts()
+        my_cell = self.maze.cell_id(my_pos)
 
-                    if len(defenders) > 0:
-                        dists = [self.get_maze_distance(my_pos, a.get_position()) for a in defenders]
-                        mindist = min(dists)
-                        if mindist < 3:
-                            features['ghost_really_close'] = 3 - mindist
-                            features['getoutofthere'] = 1
-                        elif mindist < 8:
-                            features['ghost_close'] = mindist
-                            features['getoutofthere'] = 1
-                        else:
-                            features['ghost_far'] = mindist
+        if ghosts.scared:
+            features['distance_to_scared_ghost'] = ghosts.attraction[my_cell]
 
-        features['scared_ghost_time'] = max_scared_time
+        if ghosts.defenders:
+            mindist = ghosts.danger[my_cell]
+            if mindist < 3:
+                features['ghost_really_close'] = 3 - mindist
+                features['getoutofthere'] = 1
+            elif mindist < 8:
+                features['ghost_close'] = mindist
+                features['getoutofthere'] = 1
+            else:
+                features['ghost_far'] = mindist
+
+            features['trap_risk'] = self.topology.trap_risk(my_cell, ghosts.danger)
+
+        features['scared_ghost_time'] = snapshot.max_scared_time
+        self.profiler.lap('ghosts')
 
 
-        if (self.get_score(game_state) >= self.threshold or self.food > self.maxfood) and my_scared_timer == 0:
+        if (snapshot.score >= self.threshold or self.food > self.maxfood) and my_scared_timer == 0:
             self.is_defensive = True
-        elif self.pacman_on_own_side(game_state) and len(invaders) > 0:
+        elif snapshot.on_own_side and len(invaders) > 0:
             self.is_defensive = True
         else:
             self.is_defensive = False
+        self.profiler.lap('mode')
 
 
 
@@ -485,51 +2809,21 @@ class HybridReflexAgent2(ReflexCaptureAgent):
 
     #weights are exactly the same as HybridReflexAgent1
     def get_weights(self, game_state, action):
-        my_state = game_state.get_agent_state(self.index)
+        return self.WEIGHTS[self.weight_mode(game_state)]
+
+    def weight_mode(self, game_state):
+        my_state = self.snapshot_of(game_state).my_state
         my_scared_timer = my_state.scared_timer
         if self.is_defensive and my_state.is_pacman:
-            #defensive weights
-            return {'on_defense': 100,
-                    'invader_distance': -500,
-                    'stop': -200,
-                    'reverse': -1,
-                    'distance_to_start': -30,
-                    'ghost_really_close': -500,
-                    'ghost_close': 100,
-                    'getoutofthere': -100
-                    }
+            return 'defensive_pacman'
         elif self.is_defensive and not my_state.is_pacman:
             if my_scared_timer > 0:
-                return {'flee': -500,
-                        'stop': -200,
-                        'reverse': -1
-                        }
+                return 'scared_ghost'
             else:
-                return {
-                    'num_invaders': -5000,
-                    'on_defense': 100,
-                    'invader_distance': -500,
-                    'stop': -200,
-                    'reverse': -1
-                }
+                return 'defensive_ghost'
         elif not self.is_defensive and not my_state.is_pacman:
-            #offensive weights
-            return {'successor_score': 100,
-                    'distance_to_food': -2,
-                    'ghost_really_close': -200,
-                    'ghost_close': 50,
-                    'stop': -200,
-                    'ghost_far': 20,
-                    'getoutofthere': -100,
-                    'distance_to_scared_ghost': -500
-                    }
+            return 'offensive_ghost'
         else:
-            return {'successor_score': 100,
-                    'distance_to_food': -2,
-                    'ghost_really_close': -2000,
-                    'ghost_close': 200,
-                    'stop': -200,
-                    'ghost_far': 500,
-                    'getoutofthere': -100,
-                    'distance_to_scared_ghost': -500
-                    }
+            return 'offensive_pacman'
+
+    WEIGHTS = HybridReflexAgent1.WEIGHTS
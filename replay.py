@@ -0,0 +1,138 @@
+# replay.py
+# ---------
+# Feeds the states of recorded games (capture.py --record) to the agents of
+# my_team.py, with the random module seeded per turn, and reports what every
+# agent decided and how long each decision took.  The states always follow
+# the recorded moves, so two versions of my_team see exactly the same states
+# and their decisions and move times can be compared one by one.
+#
+# Run it from the directory that contains capture.py, e.g.
+#
+#     python agents/team_name_1/replay.py replays/*.replay -o before.json
+#     (change my_team.py)
+#     python agents/team_name_1/replay.py replays/*.replay --reference before.json
+#
+# With --reference it lists every decision that changed and compares the
+# move times state by state, and exits with status 1 when a decision changed.
+# Keep team options deterministic for the comparison: the lookahead (search=1)
+# stops on a clock and its decisions depend on the speed of the machine.
+
+import argparse
+import json
+import os
+import pickle
+import random
+import sys
+import time
+
+#the contest modules (capture, layout, ...) live in the working directory
+sys.path.insert(0, os.getcwd())
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import percentiles
+
+
+def team_options(opts):
+    return dict(option.split('=', 1) for option in opts.split(',') if option)
+
+
+def replay(path, seed, opts):
+    """
+    Decisions of my_team for every recorded move of one game, as a list of
+    [turn, agent index, action, milliseconds].
+    """
+    import capture
+    import my_team
+
+    with open(path, 'rb') as f:
+        recorded = pickle.load(f)
+    moves = recorded['actions']
+    state = capture.GameState()
+    state.initialize(recorded['layout'], len(recorded['agents']) if 'agents' in recorded else 4)
+    agents = [None] * state.get_num_agents()
+    for first, second, is_red in ((0, 2, True), (1, 3, False)):
+        agents[first], agents[second] = my_team.create_team(first, second, is_red, **opts)
+
+    random.seed('%s-init' % seed)
+    for agent in agents:
+        agent.register_initial_state(state.deep_copy())
+    decisions = []
+    for turn, (index, recorded_action) in enumerate(moves):
+        random.seed('%s-%d' % (seed, turn))
+        agent = agents[index]
+        observation = agent.observation_function(state.deep_copy())
+        start = time.perf_counter()
+        action = agent.get_action(observation)
+        decisions.append([turn, index, action, (time.perf_counter() - start) * 1000])
+        state = state.generate_successor(index, recorded_action)
+        if state.is_over():
+            break
+    for agent in agents:
+        agent.final(state)
+    return decisions
+
+
+def compare(games, reference):
+    """
+    Prints the decisions that differ from the reference run and the move
+    time ratio per state, returns the number of changed decisions.
+    """
+    changed = 0
+    ratios = []
+    for path, decisions in sorted(games.items()):
+        if path not in reference:
+            print('%s: not in the reference run' % path)
+            continue
+        before = dict(((turn, index), (action, ms)) for turn, index, action, ms in reference[path])
+        for turn, index, action, ms in decisions:
+            if (turn, index) not in before:
+                continue
+            old_action, old_ms = before[turn, index]
+            if action != old_action:
+                changed += 1
+                print('%s turn %d agent %d: %s, was %s' % (path, turn, index, action, old_action))
+            if old_ms > 0:
+                ratios.append(ms / old_ms)
+    if ratios:
+        stats = percentiles(ratios)
+        print('move time relative to the reference: p50 %.3f, p95 %.3f, max %.3f over %d states' % (
+            stats['p50'], stats['p95'], stats['max'], stats['count']))
+    return changed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay recorded games through my_team and compare decisions')
+    parser.add_argument('replays', nargs='+', help='games recorded with capture.py --record')
+    parser.add_argument('--seed', default='0', help='seed of the random module, set again every turn')
+    parser.add_argument('--opts', default='', help='team options of my_team, as for --redOpts')
+    parser.add_argument('-o', '--output', help='write the decisions to this JSON file')
+    parser.add_argument('--reference', help='earlier output to compare against')
+    args = parser.parse_args(argv)
+
+    opts = team_options(args.opts)
+    games = {}
+    for path in args.replays:
+        games[path] = replay(path, args.seed, opts)
+    times = percentiles([ms for decisions in games.values() for turn, index, action, ms in decisions])
+    if times:
+        print('%d decisions: p50 %.2f ms, p95 %.2f ms, p99 %.2f ms, max %.2f ms, total %.0f ms' % (
+            times['count'], times['p50'], times['p95'], times['p99'], times['max'], times['mean'] * times['count']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'seed': args.seed, 'opts': args.opts, 'games': games}, f)
+
+    if args.reference:
+        with open(args.reference) as f:
+            reference = json.load(f)
+        if reference['seed'] != args.seed:
+            print('warning: the reference run used seed %s' % reference['seed'])
+        changed = compare(games, reference['games'])
+        if changed:
+            print('%d decisions changed' % changed)
+            return 1
+        print('all decisions are the same as in %s' % args.reference)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
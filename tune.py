@@ -0,0 +1,227 @@
+# tune.py
+# -------
+# Tunes the feature weights of the hybrid agents (WEIGHTS) and their
+# threshold/maxfood constants with the cross-entropy method: every generation
+# samples candidate parameter sets around the current mean, plays each one on
+# the same headless games against baseline_team (see benchmark.py) and moves
+# the mean to the best candidates.
+#
+# Run it from the directory that contains capture.py, e.g.
+#
+#     python agents/team_name_1/tune.py -l defaultCapture,RANDOM1 -n 4 -g 20 -w tune_run
+#
+# Every game result is appended to tune_run/cache.jsonl, keyed by parameters,
+# layout, seed and color, so no game is played twice, and the search state is
+# saved after every generation: run the same command again to resume.  The
+# best parameters so far are written to tune_run/best_params.json, play them
+# with --redOpts params=tune_run/best_params.json.
+
+import argparse
+import hashlib
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+
+#the contest modules (capture, layout, ...) live in the working directory
+sys.path.insert(0, os.getcwd())
+sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+from benchmark import TEAM, play
+from my_team import HybridReflexAgent1, HybridReflexAgent2
+
+#agent constants that are tuned besides the weights, all integers
+CONSTANTS = ('threshold', 'maxfood')
+
+
+class Parameter:
+    """
+    One tuned number: a weight (mode, feature) or an agent constant
+    (class name, attribute).
+    """
+
+    def __init__(self, group, name, initial, integer=False):
+        self.group = group
+        self.name = name
+        self.initial = initial
+        self.integer = integer
+
+    def value(self, x):
+        if self.integer:
+            return max(0, int(round(x)))
+        return round(x, 2)
+
+
+def parameter_space():
+    space = []
+    for mode, table in sorted(HybridReflexAgent1.WEIGHTS.items()):
+        for feature, weight in sorted(table.items()):
+            space.append(Parameter(('weights', mode), feature, weight))
+    for agent_class in (HybridReflexAgent1, HybridReflexAgent2):
+        agent = agent_class(0)
+        for name in CONSTANTS:
+            space.append(Parameter((agent_class.__name__,), name, getattr(agent, name), integer=True))
+    return space
+
+
+def to_params(space, vector):
+    """
+    The parameter file create_team loads (team option params) for a vector.
+    """
+    params = {}
+    for parameter, x in zip(space, vector):
+        table = params
+        for key in parameter.group:
+            table = table.setdefault(key, {})
+        table[parameter.name] = parameter.value(x)
+    return params
+
+
+def params_key(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+
+
+class GameCache:
+    """
+    Results of the games played so far, one JSON line per game.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.scores = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        game = json.loads(line)
+                    except ValueError:
+                        #the last line of an interrupted run may be cut off
+                        continue
+                    self.scores[self.key(game['params'], game['layout'], game['seed'], game['red'])] = game['score']
+
+    @staticmethod
+    def key(params, layout_name, seed, red):
+        return params, layout_name, seed, red
+
+    def has(self, params, layout_name, seed, red):
+        return self.key(params, layout_name, seed, red) in self.scores
+
+    def get(self, params, layout_name, seed, red):
+        return self.scores.get(self.key(params, layout_name, seed, red))
+
+    def add(self, params, layout_name, seed, red, score):
+        self.scores[self.key(params, layout_name, seed, red)] = score
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'params': params, 'layout': layout_name, 'seed': seed, 'red': red,
+                                'score': score}) + '\n')
+
+
+def fitness(scores):
+    """
+    Win rate (ties count half), the mean score breaks ties.  Crashed games
+    (score None) count as losses.
+    """
+    points = [.5 if s == 0 else 1. if s is not None and s > 0 else 0. for s in scores]
+    mean_score = sum(s for s in scores if s is not None) / len(scores)
+    return sum(points) / len(scores) + mean_score / 1000
+
+
+def play_candidate(task):
+    key, game = task
+    return key, play(game)
+
+
+def evaluate(candidates, games, cache, work_dir, opponent, length, pool):
+    """
+    Fitness of every candidate parameter file over the same games.  Only the
+    games missing from the cache are played.
+    """
+    tasks = {}
+    for params in candidates:
+        key = params_key(params)
+        path = os.path.join(work_dir, 'params', key + '.json')
+        if not os.path.exists(path):
+            with open(path, 'w') as f:
+                json.dump(params, f, indent=1, sort_keys=True)
+        for layout_name, seed, red in games:
+            if not cache.has(key, layout_name, seed, red):
+                tasks[key, layout_name, seed, red] = (
+                    key, (TEAM, opponent, 'params=' + os.path.abspath(path), layout_name, seed, red, length))
+    for key, result in pool.imap_unordered(play_candidate, list(tasks.values())):
+        cache.add(key, result['layout'], result['seed'], result['red'], result['score'])
+    return [fitness([cache.get(params_key(params), *game) for game in games]) for params in candidates]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tune the hybrid agents with the cross-entropy method')
+    parser.add_argument('-l', '--layouts', default='defaultCapture',
+                        help='comma separated layouts, RANDOM<n> for generated ones')
+    parser.add_argument('-n', '--seeds', type=int, default=4, help='seeds per layout, each played as red and blue')
+    parser.add_argument('-b', '--opponent', default='baseline_team', help='team to play against')
+    parser.add_argument('-i', '--length', type=int, default=1200, help='moves per game')
+    parser.add_argument('-g', '--generations', type=int, default=20, help='generations to run in total')
+    parser.add_argument('-p', '--population', type=int, default=16, help='candidates per generation')
+    parser.add_argument('--elite', type=float, default=.25, help='part of the candidates the mean moves to')
+    parser.add_argument('--sigma', type=float, default=.25, help='initial spread, relative to the initial values')
+    parser.add_argument('--smoothing', type=float, default=.7, help='weight of the new mean and spread')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the sampling')
+    parser.add_argument('-j', '--processes', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('-w', '--work-dir', default='tune_run', help='cache, search state and results')
+    args = parser.parse_args(argv)
+
+    os.makedirs(os.path.join(args.work_dir, 'params'), exist_ok=True)
+    state_path = os.path.join(args.work_dir, 'state.json')
+    best_path = os.path.join(args.work_dir, 'best_params.json')
+    space = parameter_space()
+    games = [(layout_name, seed, red) for layout_name in args.layouts.split(',')
+             for seed in range(args.seeds) for red in (True, False)]
+    cache = GameCache(os.path.join(args.work_dir, 'cache.jsonl'))
+
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+        print('resuming at generation %d' % state['generation'])
+    else:
+        state = {'generation': 0,
+                 'mean': [p.initial for p in space],
+                 'sigma': [args.sigma * abs(p.initial) or 1. for p in space],
+                 'best': None, 'best_fitness': None}
+
+    with multiprocessing.Pool(args.processes) as pool:
+        while state['generation'] < args.generations:
+            generation = state['generation']
+            #the samples only depend on the generation, so a resumed run
+            #draws the same candidates and finds their games in the cache
+            rng = random.Random('%d-%d' % (args.seed, generation))
+            vectors = [state['mean']] + [[rng.gauss(m, s) for m, s in zip(state['mean'], state['sigma'])]
+                                         for i in range(args.population - 1)]
+            candidates = [to_params(space, v) for v in vectors]
+            scores = evaluate(candidates, games, cache, args.work_dir, args.opponent, args.length, pool)
+
+            ranked = sorted(range(len(vectors)), key=lambda i: scores[i], reverse=True)
+            elite = [vectors[i] for i in ranked[:max(2, int(math.ceil(args.elite * len(vectors))))]]
+            mean = [sum(column) / len(elite) for column in zip(*elite)]
+            sigma = [math.sqrt(sum((x - m) ** 2 for x in column) / len(elite)) for column, m in zip(zip(*elite), mean)]
+            a = args.smoothing
+            state['mean'] = [a * m + (1 - a) * old for m, old in zip(mean, state['mean'])]
+            state['sigma'] = [a * s + (1 - a) * old for s, old in zip(sigma, state['sigma'])]
+            if state['best_fitness'] is None or scores[ranked[0]] > state['best_fitness']:
+                state['best'] = candidates[ranked[0]]
+                state['best_fitness'] = scores[ranked[0]]
+                with open(best_path, 'w') as f:
+                    json.dump(state['best'], f, indent=1, sort_keys=True)
+            state['generation'] = generation + 1
+            with open(state_path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(state_path + '.tmp', state_path)
+            print('generation %d: best %.3f, mean candidate %.3f, best so far %.3f' % (
+                generation, scores[ranked[0]], scores[0], state['best_fitness']))
+
+    print('best parameters written to %s' % best_path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())